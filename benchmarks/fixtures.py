@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""Synthetic HSL city bike snapshots and FMI weather responses for
+benchmarking Fillariennustin's data pipeline without network access. """
+
+__author__ = "Joonas Häkkinen"
+
+import json
+import os
+import random
+
+import pandas as pd
+
+from modules.fmi import HELSINKI, PARAMETERS
+
+STATIONS = 150
+
+# Probability of a station's bike count changing in a minute
+CHANGE_RATE = 0.05
+
+
+def station_names(stations=STATIONS):
+    """Return a list of *stations* fake station names."""
+    return ["Asema {:03d}".format(i) for i in range(stations)]
+
+
+def snapshot_filenames(minutes, start="2017-06-01 00:00:00"):
+    """Return filenames of snapshots taken once a minute from *start*."""
+    dates = pd.date_range(start, periods=minutes, freq="min")
+    return [date.strftime("stations_%Y%m%dT%H%M%SZ") for date in dates]
+
+
+def snapshot(stations=STATIONS, seed=0, bikes=None):
+    """Return a synthetic snapshot (JSON bytes) with *stations* stations.
+
+    The records look like those served by HSL: station name, coordinates
+    as a 'lat,lon' string, style, bike and slot counts and an operative
+    flag. Attributes of each station are the same in every snapshot.
+    *bikes* is a list of bike counts per station, or None to draw them
+    at random (with *seed*).
+    """
+    rnd = random.Random(seed)
+    result = []
+
+    for i, name in enumerate(station_names(stations)):
+        total = __total_slots(i)
+        count = rnd.randint(0, total) if bikes is None else bikes[i]
+        result.append({
+            "name": name,
+            "coordinates": "{:.6f},{:.6f}".format(60.15 + i * 0.001,
+                                                  24.90 + i * 0.001),
+            "style": "CB",
+            "avl_bikes": count,
+            "free_slots": total - count,
+            "total_slots": total,
+            "operative": i % 50 != 49
+        })
+
+    return json.dumps({"result": result}).encode()
+
+
+def snapshots(minutes, stations=STATIONS, seed=0):
+    """Return a list of (filename, raw bytes) tuples for *minutes*.
+
+    Bike counts change gradually, like HSL's: each minute a few
+    stations gain or lose a bike and the rest stay as they were.
+    """
+    rnd = random.Random(seed)
+    totals = [__total_slots(i) for i in range(stations)]
+    bikes = [total // 2 for total in totals]
+    result = []
+
+    for name in snapshot_filenames(minutes):
+        result.append((name, snapshot(stations, bikes=bikes)))
+        for i, total in enumerate(totals):
+            if rnd.random() < CHANGE_RATE:
+                bikes[i] = min(max(bikes[i] + rnd.choice((-1, 1)), 0),
+                               total)
+
+    return result
+
+
+def __total_slots(station):
+    """Return the number of slots of station number *station*."""
+    return (12, 16, 20, 24, 30)[station % 5]
+
+
+def write_snapshots(folder, minutes, stations=STATIONS):
+    """Write *minutes* snapshots to files in *folder*."""
+    os.makedirs(folder, exist_ok=True)
+
+    for name, raw in snapshots(minutes, stations):
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(raw)
+
+
+def wfs_capabilities(url):
+    """Return a minimal WFS 2.0 GetCapabilities response (bytes) with
+    GetFeature served at *url*.
+    """
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:WFS_Capabilities version="2.0.0"
+    xmlns:wfs="http://www.opengis.net/wfs/2.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1"
+    xmlns:xlink="http://www.w3.org/1999/xlink">
+  <ows:ServiceIdentification>
+    <ows:Title>Benchmark stub</ows:Title>
+    <ows:ServiceType>WFS</ows:ServiceType>
+    <ows:ServiceTypeVersion>2.0.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:ServiceProvider>
+    <ows:ProviderName>Benchmark stub</ows:ProviderName>
+  </ows:ServiceProvider>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetFeature">
+      <ows:DCP><ows:HTTP>
+        <ows:Get xlink:href="{url}"/>
+      </ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <wfs:FeatureTypeList/>
+</wfs:WFS_Capabilities>
+""".format(url=url).encode()
+
+
+def wfs_response(start, stop, seed=0):
+    """Return a GML response (bytes) like FMI's 'simple' stored query
+    with observations in Helsinki every 10 minutes from *start* to
+    *stop*, plus the same amount for another city.
+    """
+    rnd = random.Random(seed)
+    dates = pd.date_range(pd.Timestamp(start).ceil("10min"), stop,
+                          freq="10min")
+    members = []
+
+    for date in dates:
+        for pos in (HELSINKI, "61.49911 23.78712"):
+            for name in PARAMETERS:
+                members.append(
+                    "<wfs:member><BsWfs:BsWfsElement>"
+                    "<BsWfs:Location><gml:Point><gml:pos>{}</gml:pos>"
+                    "</gml:Point></BsWfs:Location>"
+                    "<BsWfs:Time>{}</BsWfs:Time>"
+                    "<BsWfs:ParameterName>{}</BsWfs:ParameterName>"
+                    "<BsWfs:ParameterValue>{:.1f}</BsWfs:ParameterValue>"
+                    "</BsWfs:BsWfsElement></wfs:member>".format(
+                        pos, date.strftime("%Y-%m-%dT%H:%M:%SZ"), name,
+                        rnd.uniform(0, 20)))
+
+    return ("""<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0"
+    xmlns:BsWfs="http://xml.fmi.fi/schema/wfs/2.0"
+    xmlns:gml="http://www.opengis.net/gml/3.2">
+""" + "\n".join(members) + "\n</wfs:FeatureCollection>\n").encode()
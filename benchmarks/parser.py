@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""Compare the columnar snapshot parser to the original per-snapshot
+pandas path. Run from the repository root:
+
+    python -m benchmarks.parser --minutes 500
+"""
+
+__author__ = "Joonas Häkkinen"
+
+import time
+from io import BytesIO
+
+import click
+import pandas as pd
+
+from benchmarks.fixtures import STATIONS, snapshots
+from modules.snapshots import chunks_to_frame, parse_snapshots
+
+
+def legacy_parse(snapshots):
+    """Parse *snapshots* the way __get_bike_data() originally did."""
+    data = pd.DataFrame()
+
+    for file, raw in snapshots:
+        new_data = pd.read_json(BytesIO(raw))
+        new_data = new_data.result.apply(pd.Series)
+        new_data['date_utc'] = pd.Timestamp(file[9:]).replace(second=0)
+        new_data.set_index(['date_utc', 'name'], inplace=True)
+        data = pd.concat([data, new_data])
+
+    return data
+
+
+def columnar_parse(snapshots):
+    """Parse *snapshots* with modules.snapshots."""
+    chunk, _ = parse_snapshots(snapshots)
+    return chunks_to_frame([chunk])
+
+
+@click.command()
+@click.option("--minutes", "-m", default=500,
+              help="Number of snapshots to parse.")
+@click.option("--stations", default=STATIONS,
+              help="Number of stations per snapshot.")
+def main(minutes, stations):
+    raw = snapshots(minutes, stations)
+
+    for name, parse in (("legacy", legacy_parse),
+                        ("columnar", columnar_parse)):
+        start = time.perf_counter()
+        rows = len(parse(raw))
+        elapsed = time.perf_counter() - start
+        click.echo("{:>9}: {:,} rows in {:.2f} s, {:,.0f} rows/s"
+                   .format(name, rows, elapsed, rows / elapsed))
+
+
+if __name__ == "__main__":
+    main()
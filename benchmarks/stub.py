@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""A local HTTP server standing in for HSL's snapshot storage and FMI's
+WFS in benchmarks.
+
+Snapshots are served from a folder at /citybikes/ with an index page
+like HSL's, and weather at /fmi/{api_key}/wfs, answering GetCapabilities
+and the GetFeature requests made by modules.fmi with
+benchmarks.fixtures.wfs_response(). """
+
+__author__ = "Joonas Häkkinen"
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from benchmarks.fixtures import wfs_capabilities, wfs_response
+
+
+class StubServer:
+    def __init__(self, folder):
+        """Start serving snapshots in *folder* on a free local port.
+
+        Use as a context manager, or call close() when done.
+        """
+        self.folder = folder
+        self.requests = 0
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                            self.__handler())
+        self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                         daemon=True)
+        self.__thread.start()
+
+    @property
+    def url(self):
+        """Base address of the server."""
+        host, port = self.__server.server_address
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def source_url(self):
+        """Address of the snapshot index, for Source."""
+        return self.url + "/citybikes/"
+
+    @property
+    def wfs_url(self):
+        """Address template of the WFS, for FILLARIDATA_WFS_URL."""
+        return self.url + "/fmi/{api_key}/wfs"
+
+    def close(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                url = urlparse(self.path)
+
+                if url.path == "/citybikes/":
+                    names = sorted(os.listdir(stub.folder))
+                    body = "<html><body>\n{}\n</body></html>".format(
+                        "\n".join('<a href="{0}">{0}</a>'.format(name)
+                                  for name in names)).encode()
+                elif url.path.startswith("/citybikes/"):
+                    path = os.path.join(stub.folder,
+                                        os.path.basename(url.path))
+                    if not os.path.isfile(path):
+                        self.send_error(404)
+                        return
+                    with open(path, "rb") as f:
+                        body = f.read()
+                elif url.path.startswith("/fmi/"):
+                    query = {key.lower(): value
+                             for key, value in parse_qsl(url.query)}
+                    if query.get("request", "").lower() == \
+                            "getcapabilities":
+                        body = wfs_capabilities(stub.url + url.path)
+                    else:
+                        body = wfs_response(query["starttime"],
+                                            query["endtime"])
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""Time each stage of 'fillaridata update' and the whole update offline,
+with synthetic snapshots served from a local folder and from a local
+HTTP stub of HSL and FMI (see benchmarks.stub). Run from the repository
+root:
+
+    python -m benchmarks.suite --sizes 60,500,2000
+    python -m benchmarks.suite --save    # store results as the baseline
+
+Each dataset size runs in its own process, so peak memory (RSS) is
+measured per size. Results are compared to the stored baseline and
+stages slower than REGRESSION of the baseline are flagged.
+"""
+
+__author__ = "Joonas Häkkinen"
+
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Throughput below this fraction of the baseline (or memory and file
+# size above its inverse) is reported as a regression
+REGRESSION = 0.8
+
+# API key given to the FMI stub, which accepts any
+API_KEY = "benchmark"
+
+# Snapshots are newer than this, so all of them are new to update
+START_AFTER = "2017-01-01T00:00:00Z"
+
+
+def run_size(minutes, kind):
+    """Run the benchmark for *minutes* snapshots read from a *kind*
+    ('folder' or 'http') source and return its results as a dict.
+    """
+    import pandas as pd
+
+    from benchmarks.fixtures import write_snapshots
+    from benchmarks.stub import StubServer
+    from classes.Config import Config
+    from classes.Datafile import Datafile
+    from classes.Source import Source
+    from modules import data
+    from modules.fmi import add_weather_data
+    from modules.schema import apply_schema
+
+    tmp = tempfile.mkdtemp(prefix="fillaridata-bench-")
+    folder = os.path.join(tmp, "snapshots")
+    write_snapshots(folder, minutes)
+    stages = {}
+
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        rows = len(result) if result is not None else 0
+        stages[name] = {"seconds": elapsed, "rows": rows,
+                        "rows_per_s": rows / elapsed if elapsed else 0}
+        return result
+
+    try:
+        with StubServer(folder) as stub:
+            os.environ["FILLARIDATA_WFS_URL"] = stub.wfs_url
+            path = folder if kind == "folder" else stub.source_url
+            start_after = pd.Timestamp(START_AFTER)
+
+            source = Source(path)
+            names = timed("get_filenames",
+                          getattr(data, "__get_filenames"), source,
+                          start_after)
+            bikes = timed("get_bike_data", getattr(data, "__get_bike_data"),
+                          source, names)
+            bikes = timed("generate_missing_rows",
+                          getattr(data, "__generate_missing_rows"), bikes)
+            bikes = timed("add_weather_data", add_weather_data, bikes,
+                          API_KEY)
+            source.close()
+
+            datafile = Datafile(os.path.join(tmp, "stages.h5"))
+            schema = apply_schema(bikes)
+
+            def update():
+                datafile.update(schema)
+                return schema
+
+            timed("datafile_update", update)
+
+            config = Config(tmp, "main.conf")
+            config.set("FMI", "api_key", API_KEY)
+            end_to_end = Datafile(os.path.join(tmp, "end_to_end.h5"))
+
+            def update_data():
+                data.update_data(end_to_end, config, START_AFTER, 0, 500,
+                                 path)
+                return range(end_to_end.metadata()["rows"])
+
+            timed("end_to_end", update_data)
+
+        return {
+            "stages": stages,
+            "peak_rss_mb": resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "file_mb": os.path.getsize(end_to_end.path) / 1024 ** 2
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def compare(results, baseline):
+    """Print *results* next to *baseline* and return the number of
+    regressions found.
+    """
+    regressions = 0
+
+    for key, result in results.items():
+        base = baseline.get(key)
+        click.echo(click.style(key, bold=True))
+
+        for stage, values in result["stages"].items():
+            line = "  {:<22} {:>8.2f} s {:>12,.0f} rows/s".format(
+                stage, values["seconds"], values["rows_per_s"])
+
+            if base is not None and stage in base["stages"]:
+                ratio = values["rows_per_s"] / \
+                    max(base["stages"][stage]["rows_per_s"], 1e-9)
+                slow = ratio < REGRESSION
+                regressions += slow
+                line += click.style("  {:>5.2f}x baseline".format(ratio),
+                                    fg="red" if slow else "green")
+
+            click.echo(line)
+
+        for name, unit in (("peak_rss_mb", "MB peak RSS"),
+                           ("file_mb", "MB file size")):
+            line = "  {:<22} {:>8.1f} {}".format("", result[name], unit)
+
+            if base is not None:
+                ratio = result[name] / max(base[name], 1e-9)
+                grown = ratio > 1 / REGRESSION
+                regressions += grown
+                line += click.style("  {:>5.2f}x baseline".format(ratio),
+                                    fg="red" if grown else "green")
+
+            click.echo(line)
+
+    return regressions
+
+
+@click.command()
+@click.option("--sizes", default="60,500,2000",
+              help="Comma-separated numbers of snapshots (minutes).")
+@click.option("--sources", default="folder,http",
+              help="Comma-separated source kinds: folder, http.")
+@click.option("--baseline", type=click.Path(), default=BASELINE,
+              help="Baseline results to compare to.")
+@click.option("--save", is_flag=True,
+              help="Store the results as the new baseline.")
+def main(sizes, sources, baseline, save):
+    results = {}
+    context = multiprocessing.get_context("spawn")
+
+    for kind in sources.split(","):
+        for minutes in (int(size) for size in sizes.split(",")):
+            key = "{}/{}".format(kind, minutes)
+            click.echo(" * Running {}".format(key))
+
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                results[key] = pool.submit(run_size, minutes, kind).result()
+
+    stored = {}
+    if os.path.isfile(baseline):
+        with open(baseline) as f:
+            stored = json.load(f)
+    else:
+        click.echo(" * No baseline found, run with --save to store one.")
+
+    regressions = compare(results, stored)
+
+    if save:
+        stored.update(results)
+        with open(baseline, "w") as f:
+            json.dump(stored, f, indent=2)
+        click.echo(click.style(" * Baseline saved to {}".format(baseline),
+                               fg="green"))
+
+    if regressions:
+        click.echo(click.style(" * {} regressions".format(regressions),
+                               fg="red", bold=True))
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
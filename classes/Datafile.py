@@ -7,16 +7,61 @@ stored data are provided."""
 __author__ = "Joonas Häkkinen"
 
 import logging
+import os
 from os.path import isfile
 
 import click
+import numpy as np
 import pandas as pd
 
+from classes.Journal import Journal
+from modules.delta import decode, empty_state, encode
+from modules.rollups import (ROLLUPS, aggregate, aggregate_weather, merge,
+                             summarize)
+from modules.schema import (COLUMNS, FACT_COLUMNS, SCHEMA_VERSION,
+                            WEATHER_COLUMNS, apply_schema, from_storage,
+                            memory_per_row, to_storage)
+from modules.stations import (empty_stations, join_stations, station_ids,
+                              update_stations)
+
+# Compression used for every write to the data file
+COMPLEVEL = 9
+COMPLIB = "zlib"
+
+# Rows copied at a time when migrating an old data file
+MIGRATE_CHUNKSIZE = 1000000
+
+# Range of dates read at a time by Datafile.query()
+QUERY_CHUNK = pd.Timedelta(days=1)
+
+# Attributes of the 'data' table maintained by Datafile
+DATA_ATTRS = ("schema_version", "mode", "dense_rows", "first_date",
+              "last_date")
+
+# Ways of storing station data, see modules.delta for 'delta'
+MODES = ("dense", "delta")
+
 
 class Datafile:
-    def __init__(self, path):
-        """Load data from file in *path* and return a Datafile object
-        representing that data set.
+    def __init__(self, path, mode="dense"):
+        """Return a Datafile object representing the data set in file
+        *path*. If the file is created, station data is stored in
+        *mode*: 'dense' stores every row, 'delta' only changes (see
+        modules.delta). Existing files keep the mode they were created
+        with.
+
+        The data itself is not loaded until the *data* attribute is
+        accessed. Row count, first and last dates, station count and
+        columns are answered from the file's metadata.
+
+        Each update is recorded in a Journal before writing. If the
+        previous update was interrupted, its partial writes are rolled
+        back here, unless another process is still writing.
+
+        The file holds three keys: 'data', a table of per-minute station
+        data indexed by (date_utc, station_id), 'stations', the station
+        table of modules.stations, and 'weather', a table of weather
+        data indexed by date_utc. select() joins these back together.
         """
         if not isfile(path):
             click.echo(click.style(" * Data file not found.", fg="red",
@@ -25,29 +70,333 @@ class Datafile:
                             .format(click.format_filename(path)))
 
         self.path = path
-        self.data = self.__get_data()
+        self.mode = mode
+        self.journal = Journal(path)
+        self.__data = None
+        self.__meta = None
+
+        # A write still holding the journal's lock is in progress in
+        # another process, not interrupted
+        if self.journal.pending() is not None:
+            with self.journal.lock(wait=False) as locked:
+                if locked and self.journal.pending() is not None:
+                    self.__roll_back()
+
+    @property
+    def data(self):
+        """Contents of the data file, loaded on first access."""
+        if self.__data is None:
+            self.__data = self.__get_data()
+
+        return self.__data
 
     def __get_data(self):
         """Returns contents of the data file (HDF format) if file is
         found, otherwise None.
         """
         if isfile(self.path):
-            store = pd.HDFStore(self.path)
+            store = pd.HDFStore(self.path, mode="r")
 
             if "/data" not in store.keys():
+                store.close()
                 click.echo(click.style(" * No data found in data file",
                                        fg="red", bold=True))
                 logging.warning("Data file did not include key 'data'")
                 return None
 
+            if self.__schema_version(store.get_storer("data")) \
+                    == SCHEMA_VERSION:
+                store.close()
+                return self.select()
+
             data = store['data']
             store.close()
             return data
         else:
             return None
 
+    def select(self, start=None, stop=None, stations=None, columns=None):
+        """Return data between dates *start* and *stop* (inclusive).
+
+        Station data, station attributes and weather are read from
+        their tables and joined into one DataFrame with a MultiIndex
+        (date_utc, name) and the columns of the schema. Only the rows
+        in the range are read. Either limit may be None.
+
+        If *stations* (list of names) is given, only rows of those
+        stations are read, and if *columns* is given, only those columns
+        are returned and weather is read only if needed.
+        """
+        if columns is None:
+            columns = [column for column, _ in COLUMNS]
+
+        with pd.HDFStore(self.path, mode="r") as store:
+            table = self.__read_stations(store)
+            with_weather = any(column in WEATHER_COLUMNS
+                               for column in columns)
+
+            where = self.__station_where(table, stations)
+            facts, weather = self.__read_dense(store, start, stop, where,
+                                               with_weather)
+
+        data = join_stations(from_storage(facts), table)
+
+        # Broadcast weather of each minute to all rows of that minute
+        if with_weather:
+            weather = from_storage(weather).reindex(
+                data.index.get_level_values(0))
+            for column in WEATHER_COLUMNS:
+                data[column] = weather[column].values
+
+        return data[columns]
+
+    @staticmethod
+    def __read_dense(store, start, stop, where=(), with_weather=True):
+        """Return a tuple (facts, weather) of station data (a row for
+        each station and minute) and weather between *start* and *stop*
+        in open *store*, in storage types. Station data is limited by
+        the conditions in *where*. Weather is None if not
+        *with_weather*.
+        """
+        if Datafile.__mode(store) == "delta":
+            # Rebuild from the day's keyframe on the stored minutes
+            first = None if start is None else _naive(start).floor("D")
+            weather = store.select(
+                "weather", where=Datafile.__where(first, stop, "index"))
+            facts = store.select(
+                "data", where=Datafile.__where(first, stop, "date_utc",
+                                               where))
+            facts = decode(facts, weather.index)
+
+            if start is not None:
+                dates = facts.index.get_level_values(0)
+                facts = facts[dates >= _naive(start)]
+                weather = weather[weather.index >= _naive(start)]
+        else:
+            facts = store.select(
+                "data", where=Datafile.__where(start, stop, "date_utc",
+                                               where))
+            weather = store.select(
+                "weather", where=Datafile.__where(start, stop, "index")) \
+                if with_weather else None
+
+        return facts, weather if with_weather else None
+
+    def rollup(self, name="hourly", start=None, stop=None, stations=None,
+               raw=False):
+        """Return per-station rollup *name* ('hourly' or 'daily') of
+        periods starting between *start* and *stop*.
+
+        Returns a DataFrame indexed by (period, name), see
+        modules.rollups.summarize(), or None if the file has no
+        rollups. Only the rollup tables are read. With *raw*, returns
+        the stored aggregates as a tuple (stations, weather) instead.
+
+        Arguments:
+        stations -- List of station names to include, or None for all.
+        """
+        key = "rollup_" + name
+
+        with pd.HDFStore(self.path, mode="r") as store:
+            if "/" + key not in store.keys():
+                return None
+
+            table = self.__read_stations(store)
+            where = self.__station_where(table, stations)
+            aggregates = store.select(key, where=self.__where(
+                start, stop, "period", where))
+            weather = store.select(key + "_weather", where=self.__where(
+                start, stop, "index"))
+
+        # Station ids are only unique within a file, names across files
+        names = table.drop_duplicates("station_id").set_index(
+            "station_id").name
+        aggregates.index = pd.MultiIndex.from_arrays(
+            [aggregates.index.get_level_values(0),
+             names.reindex(aggregates.index.get_level_values(1)).values],
+            names=["period", "name"])
+
+        if raw:
+            return aggregates, weather
+
+        return summarize(aggregates, weather)
+
+    def rebuild_rollups(self):
+        """Compute the rollups again from the stored data, a day at a
+        time.
+        """
+        meta = self.metadata()
+
+        if meta is None or meta["schema_version"] != SCHEMA_VERSION:
+            click.echo(click.style(" * No data in the current format "
+                                   "found.", fg="red", bold=True))
+            raise SystemExit
+
+        with pd.HDFStore(self.path, complevel=COMPLEVEL,
+                         complib=COMPLIB) as store:
+            for key, _ in self.__rollup_keys():
+                if "/" + key in store.keys():
+                    store.remove(key)
+
+            first = _naive(meta["first"]).floor("D")
+            while first <= _naive(meta["last"]):
+                stop = first + QUERY_CHUNK - pd.Timedelta(minutes=1)
+                facts, weather = self.__read_dense(store, first, stop)
+                if len(weather) > 0:
+                    self.__update_rollups(store, facts, weather)
+                first = stop + pd.Timedelta(minutes=1)
+
+        logging.info("Rebuilt rollups of {}"
+                     .format(click.format_filename(self.path)))
+
+    def query(self, start=None, stop=None, stations=None, columns=None,
+              chunk=QUERY_CHUNK):
+        """Yield data between dates *start* and *stop* in chunks.
+
+        Like select(), but the range is read *chunk* (Timedelta) at a
+        time, so memory use doesn't depend on the length of the range.
+        Empty chunks are skipped.
+        """
+        meta = self.metadata()
+
+        if meta is None:
+            return
+
+        first = _naive(meta["first"]) if start is None \
+            else max(_naive(start), _naive(meta["first"]))
+        last = _naive(meta["last"]) if stop is None \
+            else min(_naive(stop), _naive(meta["last"]))
+
+        while first <= last:
+            # Dates are whole minutes, so chunks don't overlap
+            chunk_stop = min(first + chunk - pd.Timedelta(minutes=1), last)
+            data = self.select(first, chunk_stop, stations, columns)
+
+            if len(data) > 0:
+                yield data
+
+            first = chunk_stop + pd.Timedelta(minutes=1)
+
+    def stations(self):
+        """Return the station table of this Datafile."""
+        with pd.HDFStore(self.path, mode="r") as store:
+            return self.__read_stations(store)
+
+    def metadata(self):
+        """Return a dict describing the stored data without loading it.
+
+        Keys are 'rows', 'first', 'last', 'stations', 'columns',
+        'schema_version', 'mode' and 'stored_rows' (differs from 'rows'
+        in delta mode). Returns None if the file holds no data. Old
+        fixed-format files have no metadata, so they are loaded in full.
+        """
+        if self.__meta is not None:
+            return self.__meta
+
+        if not isfile(self.path):
+            return None
+
+        store = pd.HDFStore(self.path, mode="r")
+
+        if "/data" not in store.keys():
+            store.close()
+            return None
+
+        storer = store.get_storer("data")
+
+        if storer.is_table:
+            self.__meta = self.__table_metadata(store, storer)
+            store.close()
+        else:
+            store.close()
+            click.echo(click.style(" * Loading the whole data file, run "
+                                   "'fillaridata migrate' to avoid this.",
+                                   fg="yellow"))
+            data = self.data
+            self.__meta = {
+                "rows": len(data),
+                "first": data.index.min()[0],
+                "last": data.index.max()[0],
+                "stations": len(data.index.levels[1]),
+                "columns": list(data.columns),
+                "schema_version": 0,
+                "mode": "dense",
+                "stored_rows": len(data)
+            }
+
+        return self.__meta
+
+    @staticmethod
+    def __table_metadata(store, storer):
+        """Read metadata of the 'data' table in open *store*.
+
+        Batches are appended in time order, so first and last dates are
+        found on the first and last rows of the table.
+        """
+        rows = storer.nrows
+
+        if rows == 0:
+            return None
+
+        version = Datafile.__schema_version(storer)
+        attrs = storer.attrs
+
+        if "last_date" in attrs:
+            first, last = attrs.first_date, attrs.last_date
+        else:
+            first = store.select_column("data", "date_utc", start=0,
+                                        stop=1).iloc[0]
+            last = store.select_column("data", "date_utc", start=rows - 1,
+                                       stop=rows).iloc[0]
+
+        if version >= 3:
+            stations = store["stations"].station_id.nunique()
+            columns = [column for column, _ in COLUMNS]
+        elif "stations" in storer.attrs:
+            stations = len(storer.attrs.stations)
+            columns = list(storer.non_index_axes[0][1])
+        else:
+            # Files written before station names were recorded
+            names = set()
+            for start in range(0, rows, MIGRATE_CHUNKSIZE):
+                names.update(store.select_column(
+                    "data", "name", start=start,
+                    stop=start + MIGRATE_CHUNKSIZE).unique())
+            stations = len(names)
+            columns = list(storer.non_index_axes[0][1])
+
+        return {
+            "rows": attrs.dense_rows if "dense_rows" in attrs else rows,
+            "first": first,
+            "last": last,
+            "stations": stations,
+            "columns": columns,
+            "schema_version": version,
+            "mode": Datafile.__mode(store),
+            "stored_rows": rows
+        }
+
+    @staticmethod
+    def __schema_version(storer):
+        """Return the schema version of 'data' in *storer*.
+
+        Fixed-format files are version 0 and table-format files
+        written before versions were recorded version 1.
+        """
+        if not storer.is_table:
+            return 0
+
+        return storer.attrs.schema_version \
+            if "schema_version" in storer.attrs else 1
+
     def update(self, new_data):
-        """Append *new_data* to end of *datafile* (HDF5)."""
+        """Append *new_data* to end of *datafile* (HDF5).
+
+        The data is kept in table-format stores, so only the rows in
+        *new_data* are written and nothing but the small station table
+        is read back from the file. If writing fails, the partial write
+        is rolled back before the error is passed on.
+        """
         if not isfile(self.path):
             click.echo(click.style(" * Creating data file: {}"
                                    .format(click.format_filename(self.path)),
@@ -55,18 +404,34 @@ class Datafile:
             logging.info("New data file created at {}"
                          .format(click.format_filename(self.path)))
 
-        store = pd.HDFStore(self.path, complevel=9, complib="zlib")
+        created = not isfile(self.path)
+        store = pd.HDFStore(self.path, complevel=COMPLEVEL, complib=COMPLIB)
 
-        if "/data" not in store.keys():
-            data = pd.DataFrame()
-        else:
-            data = store['data']
-            data.index.levels[0].tz = None
+        if "/data" in store.keys() and self.__schema_version(
+                store.get_storer("data")) != SCHEMA_VERSION:
+            store.close()
+            click.echo(click.style(" * Data file is in an old format. "
+                                   "Run 'fillaridata migrate' first.",
+                                   fg="red", bold=True))
+            logging.error("Refusing to append to old format data file {}"
+                          .format(click.format_filename(self.path)))
+            raise SystemExit
 
-        new_data.index.levels[0].tz = None
-        store['data'] = data.append(new_data)
-        store.data.reset_index(inplace=True)
-        store.close()
+        with self.journal.lock():
+            self.journal.begin(self.__undo_record(store, created))
+            try:
+                self.__append(store, new_data, self.mode)
+            except Exception:
+                # Undo the partial write, so later updates (e.g. the
+                # next poll of 'follow') start from a consistent file
+                store.close()
+                self.__roll_back()
+                raise
+            finally:
+                store.close()
+            self.journal.commit()
+        self.__data = None
+        self.__meta = None
 
         # Log the changes that we just wrote
         rows = len(new_data)
@@ -74,23 +439,432 @@ class Datafile:
         logging.info("Wrote {:,} rows ({:,} unique timestamps) to {}"
                      .format(rows, dates, click.format_filename(self.path)))
 
+    def fill_weather(self, weather, start):
+        """Fill in missing weather of minutes from *start* on in place.
+
+        Weather written as missing (e.g. not yet published when the
+        minute was appended) is replaced with the values in *weather*,
+        a DataFrame indexed by date (UTC). Other values are left as
+        they are. Weather rollups of the periods filled are recomputed.
+        Returns the first stored minute still missing weather after
+        filling, or None.
+        """
+        weather = weather.copy()
+        if weather.index.tz is not None:
+            weather.index = weather.index.tz_convert(None)
+
+        with pd.HDFStore(self.path, complevel=COMPLEVEL,
+                         complib=COMPLIB) as store:
+            table = store.get_storer("weather").table
+            rows = table.get_where_list("index >= {}".format(
+                _naive(start).value))
+
+            if len(rows) == 0:
+                return None
+
+            # Weather columns are all float32, stored in one block
+            columns = store.get_storer("weather").non_index_axes[0][1]
+            stored = table.read(start=rows[0])
+            dates = pd.DatetimeIndex(stored["index"].astype("datetime64[ns]"))
+            new = weather.reindex(index=dates, columns=columns) \
+                .to_numpy(np.float32)
+
+            values = stored["values_block_0"]
+            missing = np.isnan(values) & ~np.isnan(new)
+            values[missing] = new[missing]
+            stored["values_block_0"] = values
+            table.modify_rows(start=rows[0], rows=stored)
+
+            filled = missing.any(axis=1)
+            if filled.any():
+                self.__refresh_rollup_weather(store, dates[filled][0])
+
+        still = np.isnan(values).any(axis=1)
+        return dates[still][0].tz_localize("UTC") if still.any() else None
+
+    def migrate(self):
+        """Convert a data file in an old format to the current format.
+
+        The old file is copied in chunks to a temporary file which then
+        replaces the original, so an interrupted migration leaves the
+        original file untouched. Fixed-format files can't be read in
+        row ranges (the index levels would be sliced too), so they are
+        read once and appended in chunks. Chunks end on a whole minute,
+        as weather is appended once per minute of each chunk.
+        """
+        if not isfile(self.path):
+            click.echo(click.style(" * Exiting, no data file found.",
+                                   fg="red", bold=True))
+            logging.error("No data file found for Datafile.migrate()")
+            raise SystemExit
+
+        store = pd.HDFStore(self.path, mode="r")
+
+        if "/data" not in store.keys():
+            store.close()
+            click.echo(click.style(" * No data found in data file",
+                                   fg="red", bold=True))
+            logging.warning("Data file did not include key 'data'")
+            raise SystemExit
+
+        storer = store.get_storer("data")
+        version = self.__schema_version(storer)
+
+        if version == SCHEMA_VERSION:
+            store.close()
+            click.echo(click.style(" * Data file is already in the current "
+                                   "format.", fg="green"))
+            return
+
+        tmp_path = self.path + ".migrating"
+        if isfile(tmp_path):
+            os.remove(tmp_path)
+
+        tmp_store = pd.HDFStore(tmp_path, complevel=COMPLEVEL,
+                                complib=COMPLIB)
+        rows = 0
+        data = None if storer.is_table else store.get("data")
+        total = storer.nrows if data is None else len(data)
+
+        while True:
+            if data is None:
+                chunk = store.select("data", start=rows,
+                                     stop=rows + MIGRATE_CHUNKSIZE)
+            else:
+                chunk = data.iloc[rows:rows + MIGRATE_CHUNKSIZE]
+            if len(chunk) == 0:
+                break
+
+            # Leave the last minute to the next chunk, unless it's all
+            # there or fills the whole chunk
+            if rows + len(chunk) < total:
+                dates = chunk.index.get_level_values(0)
+                whole = dates != dates[-1]
+                if whole.any():
+                    chunk = chunk[whole]
+            chunk.index = chunk.index.remove_unused_levels()
+
+            # Version 2 stored missing values as MISSING
+            if version == 2:
+                chunk = from_storage(chunk)
+
+            self.__append(tmp_store, chunk, self.mode)
+            rows += len(chunk)
+            click.echo(" * {:,} rows migrated".format(rows))
+
+        tmp_store.close()
+        store.close()
+        os.replace(tmp_path, self.path)
+
+        click.echo(click.style(" * Data file migrated to the current format.",
+                               fg="green"))
+        logging.info("Migrated {:,} rows in {} to schema version {}"
+                     .format(rows, click.format_filename(self.path),
+                             SCHEMA_VERSION))
+
+    @staticmethod
+    def __append(store, new_data, mode):
+        """Append *new_data* to the tables in open *store*.
+
+        The station table is updated with the attributes in *new_data*,
+        station data is appended to 'data' keyed by station id and
+        weather to 'weather', one row per minute. Dates are stored
+        without time zone (UTC) and columns in the types given by
+        modules.schema.to_storage(). If 'data' is created, station data
+        is stored in *mode*, otherwise in the mode of the file.
+        """
+        if "/data" in store.keys():
+            mode = Datafile.__mode(store)
+
+        new_data = apply_schema(new_data)
+
+        dates = new_data.index.levels[0]
+        if dates.tz is not None:
+            new_data.index = new_data.index.set_levels(
+                dates.tz_convert(None), level=0)
+
+        stations = update_stations(Datafile.__read_stations(store), new_data)
+        store.put("stations", to_storage(stations))
+
+        # Station data keyed by (date_utc, station_id)
+        facts = to_storage(new_data[FACT_COLUMNS])
+        ids = station_ids(stations).reindex(facts.index.levels[1]).values
+        facts.index = facts.index.set_levels(ids, level=1)
+        facts.index.names = ["date_utc", "station_id"]
+
+        # Weather is the same for all stations, store it once per minute
+        codes = new_data.index.codes[0]
+        _, first_rows = np.unique(codes, return_index=True)
+        weather = to_storage(new_data[WEATHER_COLUMNS].iloc[first_rows])
+        weather.index = weather.index.get_level_values(0)
+
+        # A minute split between appends keeps its first weather row
+        if "/data" in store.keys() and \
+                "last_date" in store.get_storer("data").attrs:
+            last_date = store.get_storer("data").attrs.last_date
+            weather = weather[weather.index > last_date]
+
+        Datafile.__update_rollups(store, facts, weather)
+
+        if mode == "delta":
+            if "/delta_state" in store.keys():
+                state = store["delta_state"]
+                last_date = store.get_storer("data").attrs.last_date
+            else:
+                state, last_date = empty_state(), None
+
+            facts, state = encode(facts, state, last_date)
+            store.put("delta_state", state)
+
+        if len(facts) > 0:
+            store.append("data", facts, format="table")
+
+        if len(weather) > 0:
+            store.append("weather", weather, format="table")
+
+        attrs = store.get_storer("data").attrs
+        attrs.schema_version = SCHEMA_VERSION
+        attrs.mode = mode
+        attrs.dense_rows = len(new_data) + \
+            (attrs.dense_rows if "dense_rows" in attrs else 0)
+        # Levels may hold dates not in the data, e.g. in slices of a batch
+        dates = new_data.index.get_level_values(0)
+        if "first_date" not in attrs:
+            attrs.first_date = dates.min()
+        attrs.last_date = dates.max()
+
+    @staticmethod
+    def __update_rollups(store, facts, weather):
+        """Add dense station data *facts* and *weather* (storage types)
+        to the rollups in open *store*.
+
+        Only the last stored period can overlap the new data, so its
+        rows are read back, merged with the new ones and rewritten.
+        """
+        for name, freq in ROLLUPS.items():
+            stations, periods = aggregate(facts, weather, freq)
+            key = "rollup_" + name
+            first = stations.index.get_level_values(0).min()
+
+            if "/" + key in store.keys():
+                where = ['period >= "{}"'.format(first)]
+                weather_where = ['index >= "{}"'.format(first)]
+                old = store.select(key, where=where)
+                old_weather = store.select(key + "_weather",
+                                           where=weather_where)
+
+                if len(old) > 0 or len(old_weather) > 0:
+                    store.remove(key, where=where)
+                    store.remove(key + "_weather", where=weather_where)
+                    stations, periods = merge([old, stations],
+                                              [old_weather, periods])
+
+            store.append(key, stations, format="table")
+            if len(periods) > 0:
+                store.append(key + "_weather", periods, format="table")
+
+    @staticmethod
+    def __refresh_rollup_weather(store, first):
+        """Recompute the weather rollups in open *store* of the periods
+        from the one of date *first* on from the weather table.
+        """
+        for name, freq in ROLLUPS.items():
+            key = "rollup_{}_weather".format(name)
+            if "/" + key not in store.keys():
+                continue
+
+            where = ['index >= "{}"'.format(first.floor(freq))]
+            weather = store.select("weather", where=where)
+            store.remove(key, where=where)
+            store.append(key, aggregate_weather(weather, freq),
+                         format="table")
+
+    @staticmethod
+    def __rollup_keys():
+        """Return keys of the rollup tables and the column holding
+        their period.
+        """
+        return [(key + suffix, column) for key in ("rollup_" + name
+                                                   for name in ROLLUPS)
+                for suffix, column in (("", "period"),
+                                       ("_weather", "index"))]
+
+    @staticmethod
+    def __undo_record(store, created):
+        """Return what's needed to undo an append to open *store*: row
+        counts of the tables and copies of the small keys rewritten on
+        each append.
+        """
+        keys = store.keys()
+        record = {"created": created, "rows": {}, "keys": {}, "attrs": {}}
+
+        for key in ("data", "weather"):
+            record["rows"][key] = store.get_storer(key).nrows \
+                if "/" + key in keys else 0
+
+        for key in ("stations", "delta_state"):
+            record["keys"][key] = store[key] if "/" + key in keys else None
+
+        # Rows of the last period of rollups are rewritten by appends
+        record["tails"] = {}
+        for key, column in Datafile.__rollup_keys():
+            if "/" + key not in keys:
+                record["tails"][key] = (0, None)
+                continue
+
+            rows = store.get_storer(key).nrows
+            last = store.select_column(key, column, start=rows - 1).iloc[0]
+            record["tails"][key] = (rows, store.select(
+                key, where=['{} >= "{}"'.format(column, last)]))
+
+        if "/data" in keys:
+            attrs = store.get_storer("data").attrs
+            record["attrs"] = {name: attrs[name] for name in DATA_ATTRS
+                               if name in attrs}
+
+        return record
+
+    def __roll_back(self):
+        """Undo the writes of an interrupted update."""
+        record = self.journal.pending()
+
+        if record["created"]:
+            if isfile(self.path):
+                os.remove(self.path)
+        else:
+            with pd.HDFStore(self.path, complevel=COMPLEVEL,
+                             complib=COMPLIB) as store:
+                keys = store.keys()
+
+                for key, rows in record["rows"].items():
+                    if "/" + key not in keys:
+                        continue
+                    if rows == 0:
+                        store.remove(key)
+                    elif store.get_storer(key).nrows > rows:
+                        store.remove(key, start=rows)
+
+                for key, value in record["keys"].items():
+                    if value is not None:
+                        store.put(key, value)
+                    elif "/" + key in keys:
+                        store.remove(key)
+
+                for key, (rows, tail) in record.get("tails", {}).items():
+                    if "/" + key not in keys:
+                        continue
+                    if rows == 0:
+                        store.remove(key)
+                    else:
+                        store.remove(key, start=rows - len(tail))
+                        store.append(key, tail, format="table")
+
+                if "/data" in store.keys():
+                    attrs = store.get_storer("data").attrs
+                    for name in DATA_ATTRS:
+                        if name in record["attrs"]:
+                            attrs[name] = record["attrs"][name]
+                        elif name in attrs:
+                            del attrs[name]
+
+        self.journal.commit()
+        click.echo(click.style(" * Rolled back an interrupted update.",
+                               fg="yellow"))
+        logging.warning("Rolled back an interrupted update of {}"
+                        .format(click.format_filename(self.path)))
+
+    @staticmethod
+    def __mode(store):
+        """Return the storage mode of 'data' in open *store*."""
+        attrs = store.get_storer("data").attrs
+        return attrs.mode if "mode" in attrs else "dense"
+
+    @staticmethod
+    def __read_stations(store):
+        """Return the station table in open *store*."""
+        if "/stations" not in store.keys():
+            return empty_stations()
+
+        return from_storage(store["stations"])
+
+    @staticmethod
+    def __station_where(table, stations):
+        """Return a where clause selecting the ids of stations named in
+        *stations* in station *table*, or none if *stations* is None.
+        If none of the stations are in the table, the clause selects
+        nothing.
+        """
+        if stations is None:
+            return []
+
+        ids = table.station_id[table.name.isin(stations)].unique()
+        if len(ids) == 0:
+            # Station ids are never negative
+            return ["station_id < 0"]
+
+        return ["station_id = {}".format([int(i) for i in ids])]
+
+    @staticmethod
+    def __where(start, stop, column, where=()):
+        """Return a where clause selecting dates *start* - *stop* in
+        *column* and the conditions in *where*, or None if there are no
+        conditions.
+        """
+        where = list(where)
+
+        if start is not None:
+            where.append('{} >= "{}"'.format(column, _naive(start)))
+        if stop is not None:
+            where.append('{} <= "{}"'.format(column, _naive(stop)))
+
+        return where or None
+
     def print_info(self):
         """Print information about current data file."""
-        if self.data is None:
+        meta = self.metadata()
+
+        if meta is None:
             click.echo(click.style(" * Exiting, no data found.", fg="red",
                                    bold=True))
             logging.error("No data found for Datafile.print_info()")
             raise SystemExit
 
         click.echo("Data file: {}".format(self.path))
-        click.echo("Number of rows: {:,}".format(self.data.shape[0],
-                                                 grouping=True))
-        click.echo("First entry: {}".format(self.data.index.min()[0]))
+        click.echo("Number of rows: {:,}".format(meta["rows"]))
+        if meta["mode"] == "delta":
+            click.echo("Stored rows (changes only): {:,}"
+                       .format(meta["stored_rows"]))
+        click.echo("Number of stations: {:,}".format(meta["stations"]))
+        click.echo("First entry: {}".format(meta["first"]))
         click.echo("Last entry: {}".format(self.last_date()))
+        click.echo("Columns: {}".format(", ".join(meta["columns"])))
+
+        # Size on disk and estimated size when loaded
+        size = os.path.getsize(self.path)
+        click.echo("File size: {:,.1f} MB ({:.1f} bytes/row)"
+                   .format(size / 1024 ** 2, size / meta["rows"]))
+
+        if meta["schema_version"] == SCHEMA_VERSION:
+            memory = memory_per_row() * meta["rows"]
+            click.echo("Memory when loaded: ~{:,.1f} MB ({} bytes/row)"
+                       .format(memory / 1024 ** 2, memory_per_row()))
+        else:
+            click.echo("Schema version: {} (current: {}), run 'fillaridata "
+                       "migrate' to reduce size".format(
+                           meta["schema_version"], SCHEMA_VERSION))
 
     def last_date(self):
-        """Return the date of the last entry in this Datafile."""
-        if self.data is None:
+        """Return the date (UTC) of the last entry in this Datafile."""
+        meta = self.metadata()
+
+        if meta is None:
             return pd.to_datetime("20160101T000000Z")
-        else:
-            return self.data.index.max()[0]
+
+        last = pd.Timestamp(meta["last"])
+        return last.tz_localize("UTC") if last.tz is None else last
+
+
+def _naive(date):
+    """Return *date* as a time zone naive (UTC) Timestamp."""
+    date = pd.Timestamp(date)
+    return date.tz_convert(None) if date.tz is not None else date
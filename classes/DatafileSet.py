@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+"""This class represents a data set split into time partitions, one
+data file (see Datafile) per period, in a directory together with a
+manifest describing each partition. It offers the same functionality
+as Datafile, but only touches the partitions needed."""
+
+__author__ = "Joonas Häkkinen"
+
+import json
+import logging
+import os
+from os.path import isdir, isfile
+
+import click
+import pandas as pd
+
+from classes.Datafile import QUERY_CHUNK, Datafile
+from modules.rollups import merge, summarize
+from modules.schema import SCHEMA_VERSION, apply_schema, memory_per_row
+
+# Name of the manifest file in the data directory
+MANIFEST = "manifest.json"
+
+# Supported partition periods and the date format naming their files
+PERIODS = {
+    "day": "%Y-%m-%d",
+    "week": "%G-W%V",
+    "month": "%Y-%m"
+}
+
+
+class DatafileSet:
+    def __init__(self, path, period="month", mode="dense"):
+        """Return a DatafileSet object representing the data set in
+        directory *path*.
+
+        New data is written to one data file per *period* ('day',
+        'week' or 'month'), whose station data is stored in *mode* (see
+        Datafile). Period and mode are recorded in the manifest when the
+        set is created; an existing set keeps its own.
+
+        The manifest lists each partition's file, time range, row count
+        and schema version, so last_date() and metadata() don't need to
+        open any data file, and select() only opens the partitions that
+        overlap the requested range.
+        """
+        if not isdir(path):
+            click.echo(click.style(" * Data directory not found.", fg="red",
+                                   bold=True))
+            logging.warning("Data directory not found at {}"
+                            .format(click.format_filename(path)))
+
+        self.path = path
+        self.period = period
+        self.mode = mode
+        self.__partitions = []
+        self.__data = None
+
+        self.__load_manifest()
+
+    @property
+    def data(self):
+        """Contents of the whole data set, loaded on first access."""
+        if self.__data is None and self.__partitions:
+            self.__data = self.select()
+
+        return self.__data
+
+    def partitions(self, start=None, stop=None):
+        """Return manifest entries of partitions with data between
+        dates *start* and *stop* (inclusive), in time order. Either
+        limit may be None.
+        """
+        partitions = self.__partitions
+
+        if start is not None:
+            start = _utc(start)
+            partitions = [p for p in partitions if _utc(p["last"]) >= start]
+        if stop is not None:
+            stop = _utc(stop)
+            partitions = [p for p in partitions if _utc(p["first"]) <= stop]
+
+        return partitions
+
+    def select(self, start=None, stop=None, stations=None, columns=None):
+        """Return data between dates *start* and *stop* (inclusive).
+
+        Only the partitions overlapping the range are read, see
+        Datafile.select() for the format and the other arguments.
+        """
+        frames = [self.__datafile(partition).select(start, stop, stations,
+                                                    columns)
+                  for partition in self.partitions(start, stop)]
+
+        if not frames:
+            return None
+
+        # Categories differ between partitions
+        return apply_schema(pd.concat(frames))[frames[0].columns]
+
+    def query(self, start=None, stop=None, stations=None, columns=None,
+              chunk=QUERY_CHUNK):
+        """Yield data between dates *start* and *stop* in chunks, see
+        Datafile.query(). Only the partitions overlapping the range are
+        opened.
+        """
+        for partition in self.partitions(start, stop):
+            yield from self.__datafile(partition).query(
+                start, stop, stations, columns, chunk)
+
+    def stations(self):
+        """Return the station tables of all partitions, with the
+        partition's file name as the first index level. Station ids are
+        only unique within a partition.
+        """
+        return pd.concat({partition["file"]:
+                          self.__datafile(partition).stations()
+                          for partition in self.__partitions})
+
+    def metadata(self):
+        """Return a dict describing the stored data, see
+        Datafile.metadata(). Answered from the manifest and the station
+        tables, which are small. Returns None if the set is empty.
+        """
+        if not self.__partitions:
+            return None
+
+        names = set()
+        for partition in self.__partitions:
+            names.update(self.__datafile(partition).stations().name)
+
+        return {
+            "rows": sum(p["rows"] for p in self.__partitions),
+            "first": self.__partitions[0]["first"],
+            "last": self.__partitions[-1]["last"],
+            "stations": len(names),
+            "columns": self.__partitions[-1]["columns"],
+            "schema_version": min(p["schema_version"]
+                                  for p in self.__partitions),
+            "mode": self.mode,
+            "stored_rows": sum(p["stored_rows"] for p in self.__partitions)
+        }
+
+    def update(self, new_data):
+        """Append *new_data* to the partitions of its dates.
+
+        Partitions are created as needed, so a new period starts a new
+        data file. The manifest is rewritten after each partition.
+        """
+        if not isdir(self.path):
+            os.makedirs(self.path)
+            click.echo(click.style(" * Creating data directory: {}"
+                                   .format(click.format_filename(self.path)),
+                                   fg="green"))
+            logging.info("New data directory created at {}"
+                         .format(click.format_filename(self.path)))
+
+        dates = new_data.index.get_level_values(0)
+        keys = dates.strftime(PERIODS[self.period])
+
+        for key in keys.unique():
+            filename = "{}.h5".format(key)
+            datafile = Datafile(os.path.join(self.path, filename), self.mode)
+            part = new_data[keys == key]
+            part.index = part.index.remove_unused_levels()
+            datafile.update(part)
+            self.__set_partition(filename, datafile.metadata())
+
+        self.__data = None
+
+    def rollup(self, name="hourly", start=None, stop=None, stations=None):
+        """Return rollup *name* of periods starting between *start* and
+        *stop*, see Datafile.rollup(). Periods split between partitions
+        are merged.
+        """
+        parts = [self.__datafile(partition).rollup(name, start, stop,
+                                                   stations, raw=True)
+                 for partition in self.partitions(start, stop)]
+        parts = [part for part in parts if part is not None]
+
+        if not parts:
+            return None
+
+        aggregates, weather = merge([part[0] for part in parts],
+                                    [part[1] for part in parts])
+        return summarize(aggregates, weather)
+
+    def rebuild_rollups(self):
+        """Compute the rollups of each partition again."""
+        for partition in self.__partitions:
+            click.echo(" * Rebuilding rollups of {}".format(
+                partition["file"]))
+            self.__datafile(partition).rebuild_rollups()
+
+    def fill_weather(self, weather, start):
+        """Fill in missing weather of minutes from *start* on in place,
+        see Datafile.fill_weather().
+        """
+        still = None
+
+        for partition in self.partitions(start=start):
+            first = self.__datafile(partition).fill_weather(weather, start)
+            still = first if still is None else still
+
+        return still
+
+    def migrate(self):
+        """Convert partitions in an old format to the current format."""
+        for partition in self.__partitions:
+            if partition["schema_version"] == SCHEMA_VERSION:
+                continue
+
+            datafile = self.__datafile(partition)
+            datafile.migrate()
+            self.__set_partition(partition["file"], datafile.metadata())
+
+        click.echo(click.style(" * All partitions are in the current "
+                               "format.", fg="green"))
+
+    def print_info(self):
+        """Print information about current data set."""
+        meta = self.metadata()
+
+        if meta is None:
+            click.echo(click.style(" * Exiting, no data found.", fg="red",
+                                   bold=True))
+            logging.error("No data found for DatafileSet.print_info()")
+            raise SystemExit
+
+        click.echo("Data directory: {}".format(self.path))
+        click.echo("Partitions: {:,} (one per {}, {} storage)"
+                   .format(len(self.__partitions), self.period, self.mode))
+        click.echo("Number of rows: {:,}".format(meta["rows"]))
+        if meta["mode"] == "delta":
+            click.echo("Stored rows (changes only): {:,}"
+                       .format(meta["stored_rows"]))
+        click.echo("Number of stations: {:,}".format(meta["stations"]))
+        click.echo("First entry: {}".format(meta["first"]))
+        click.echo("Last entry: {}".format(self.last_date()))
+        click.echo("Columns: {}".format(", ".join(meta["columns"])))
+
+        size = sum(os.path.getsize(os.path.join(self.path, p["file"]))
+                   for p in self.__partitions)
+        click.echo("Total size: {:,.1f} MB ({:.1f} bytes/row)"
+                   .format(size / 1024 ** 2, size / meta["rows"]))
+
+        # Only one partition needs to fit in memory at a time
+        largest = max(p["rows"] for p in self.__partitions)
+        click.echo("Memory per partition when loaded: up to ~{:,.1f} MB"
+                   .format(memory_per_row() * largest / 1024 ** 2))
+
+        for partition in self.__partitions:
+            click.echo("  {}: {} - {}, {:,} rows".format(
+                partition["file"], partition["first"], partition["last"],
+                partition["rows"]))
+
+    def last_date(self):
+        """Return the date (UTC) of the last entry in this data set."""
+        if not self.__partitions:
+            return pd.to_datetime("20160101T000000Z")
+
+        return _utc(self.__partitions[-1]["last"])
+
+    def __datafile(self, partition):
+        return Datafile(os.path.join(self.path, partition["file"]),
+                        self.mode)
+
+    def __set_partition(self, filename, meta):
+        """Record metadata *meta* of partition *filename* in the
+        manifest.
+        """
+        entry = {
+            "file": filename,
+            "first": str(meta["first"]),
+            "last": str(meta["last"]),
+            "rows": int(meta["rows"]),
+            "stored_rows": int(meta["stored_rows"]),
+            "schema_version": int(meta["schema_version"]),
+            "columns": list(meta["columns"])
+        }
+
+        partitions = [p for p in self.__partitions if p["file"] != filename]
+        partitions.append(entry)
+        self.__partitions = sorted(partitions, key=lambda p: _utc(p["first"]))
+        self.__save_manifest()
+
+    def __load_manifest(self):
+        path = os.path.join(self.path, MANIFEST)
+
+        if not isdir(self.path):
+            return
+
+        if isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+
+            self.period = manifest["period"]
+            self.mode = manifest["mode"]
+            self.__partitions = manifest["partitions"]
+
+        # If an update was interrupted, the last partition may have been
+        # written or a new one created after the manifest
+        listed = [p["file"] for p in self.__partitions]
+        unlisted = sorted(f for f in os.listdir(self.path)
+                          if f.endswith(".h5") and f not in listed)
+
+        for filename in listed[-1:] + unlisted:
+            meta = Datafile(os.path.join(self.path, filename),
+                            self.mode).metadata()
+            known = [p for p in self.__partitions if p["file"] == filename]
+
+            if meta is not None and (not known or
+                                     known[0]["rows"] != meta["rows"]):
+                logging.warning("Manifest out of date for {}, updated"
+                                .format(filename))
+                self.__set_partition(filename, meta)
+
+    def __save_manifest(self):
+        """Write the manifest, replacing the old one only when the new
+        one is complete.
+        """
+        path = os.path.join(self.path, MANIFEST)
+
+        with open(path + ".tmp", "w") as f:
+            json.dump({"period": self.period, "mode": self.mode,
+                       "partitions": self.__partitions}, f, indent=2)
+
+        os.replace(path + ".tmp", path)
+
+
+def is_datafile_set(path):
+    """Return True if *path* is a directory, i.e. holds a DatafileSet."""
+    return isdir(path)
+
+
+def _utc(date):
+    """Return *date* as a UTC Timestamp."""
+    date = pd.Timestamp(date)
+    return date.tz_localize("UTC") if date.tz is None else date.tz_convert(
+        "UTC")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""This class represents the journal of a data file: batches fetched but
+not yet written, and a record of the write in progress. Together they
+let an interrupted update be rolled back to the last complete batch and
+resumed without fetching staged batches again. Writes hold the
+journal's lock, so a write in progress in another process isn't taken
+for an interrupted one."""
+
+__author__ = "Joonas Häkkinen"
+
+import logging
+import os
+from contextlib import contextmanager
+from os.path import isfile
+
+import click
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks (e.g. on Windows), writes aren't guarded
+    fcntl = None
+
+# Name of the record of the write in progress
+PENDING = "pending.pkl"
+
+# File locked while writing, see Journal.lock()
+LOCK = "lock"
+
+
+class Journal:
+    def __init__(self, path):
+        """Return the Journal of the data file (or directory) in *path*.
+
+        The journal is kept in folder '*path*.journal', created on
+        first write. Every file in it is written to a temporary file
+        first and then renamed, so files are either complete or missing.
+        """
+        self.directory = path.rstrip("/\\") + ".journal"
+
+    def stage(self, new_data):
+        """Save batch *new_data* until it's written and return its
+        name. Batches are named by their first date, so names sort in
+        time order.
+        """
+        first = new_data.index.get_level_values(0).min()
+        name = "batch-{}.pkl".format(first.strftime("%Y%m%dT%H%M%S"))
+        self.__write(name, new_data)
+        return name
+
+    def staged(self):
+        """Return names of staged batches in time order."""
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted(f for f in os.listdir(self.directory)
+                      if f.startswith("batch-") and f.endswith(".pkl"))
+
+    def load(self, name):
+        """Return staged batch *name*."""
+        return pd.read_pickle(self.__path(name))
+
+    def done(self, name):
+        """Drop staged batch *name* after it's written."""
+        self.__remove(name)
+
+    def begin(self, record):
+        """Save *record* (any picklable object) describing how to undo
+        the write about to start.
+        """
+        self.__write(PENDING, record)
+
+    def pending(self):
+        """Return the record of an unfinished write, or None."""
+        if not isfile(self.__path(PENDING)):
+            return None
+
+        return pd.read_pickle(self.__path(PENDING))
+
+    def commit(self):
+        """Mark the write started with begin() finished."""
+        self.__remove(PENDING)
+
+    @contextmanager
+    def lock(self, wait=True):
+        """Hold the journal's write lock in a with block.
+
+        Yields True once the lock is held. Without *wait*, yields False
+        at once if another process holds it. The lock is released when
+        the process ends, so a crashed writer doesn't hold it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(self.__path(LOCK), "a") as f:
+            if fcntl is None:
+                yield True
+                return
+
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __write(self, name, obj):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.__path(name)
+        pd.to_pickle(obj, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def __remove(self, name):
+        try:
+            os.remove(self.__path(name))
+        except FileNotFoundError:
+            logging.warning("Journal entry {} already removed from {}"
+                            .format(name,
+                                    click.format_filename(self.directory)))
+
+    def __path(self, name):
+        return os.path.join(self.directory, name)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""This class represents an on-disk cache of raw city bike snapshots.
+Snapshots are immutable, so once fetched they can be served from the
+cache instead of HSL's storage."""
+
+__author__ = "Joonas Häkkinen"
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# Eviction candidates read at a time when the cache is over its size limit
+EVICT_BATCH = 100
+
+
+class SnapshotCache:
+    def __init__(self, directory, max_size):
+        """Open the cache in *directory* or create it if not found.
+
+        Snapshots are stored compressed and content-addressed (by the
+        SHA-256 of their contents), with an SQLite index mapping
+        snapshot names to contents. When the stored contents exceed
+        *max_size* bytes, the least recently used snapshots are
+        evicted until it fits again. The size of the stored contents
+        is summed once here and kept up to date by put(), so checking
+        it is cheap.
+
+        Arguments:
+        directory -- Path to cache directory.
+        max_size -- Size limit of the cache in bytes.
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(os.path.join(self.directory,
+                                                 "index.sqlite"),
+                                    check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                          "name TEXT PRIMARY KEY, digest TEXT NOT NULL, "
+                          "atime REAL NOT NULL)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS entries_atime "
+                          "ON entries (atime)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                          "digest TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+        self.__db.commit()
+        self.__total = self.__db.execute(
+            "SELECT SUM(size) FROM blobs").fetchone()[0] or 0
+
+    def get(self, name):
+        """Return contents of snapshot *name* or None if not cached."""
+        with self.__lock:
+            row = self.__db.execute("SELECT digest FROM entries "
+                                    "WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+
+        try:
+            with open(self.__blob_path(row[0]), "rb") as f:
+                raw = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            logging.warning("Dropping broken cache entry {}: {}"
+                            .format(name, e))
+            with self.__lock:
+                self.__db.execute("DELETE FROM entries WHERE name = ?",
+                                  (name,))
+            return None
+
+        with self.__lock:
+            self.__db.execute("UPDATE entries SET atime = ? WHERE name = ?",
+                              (time.time(), name))
+        return raw
+
+    def put(self, name, raw):
+        """Store contents *raw* (bytes) of snapshot *name*."""
+        digest = hashlib.sha256(raw).hexdigest()
+        path = self.__blob_path(digest)
+        data = zlib.compress(raw)
+
+        with self.__lock:
+            known = self.__db.execute("SELECT size FROM blobs "
+                                      "WHERE digest = ?",
+                                      (digest,)).fetchone()
+
+            if known is None or not os.path.isfile(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+                self.__db.execute("INSERT OR REPLACE INTO blobs "
+                                  "VALUES (?, ?)", (digest, len(data)))
+                self.__total += len(data) - (known[0] if known else 0)
+
+            self.__db.execute("INSERT OR REPLACE INTO entries "
+                              "VALUES (?, ?, ?)", (name, digest, time.time()))
+            self.__evict(name)
+            self.__db.commit()
+
+    def size(self):
+        """Return the size of stored contents in bytes."""
+        with self.__lock:
+            return self.__size()
+
+    def close(self):
+        """Save access times and close the cache index."""
+        with self.__lock:
+            self.__db.commit()
+            self.__db.close()
+
+    def __size(self):
+        return self.__total
+
+    def __evict(self, keep):
+        """Drop least recently used snapshots, other than *keep*, until
+        the cache fits in *max_size*. Must be called holding the lock.
+        """
+        while self.__size() > self.max_size:
+            oldest = self.__db.execute("SELECT name, digest FROM entries "
+                                       "WHERE name != ? ORDER BY atime, "
+                                       "rowid LIMIT ?",
+                                       (keep, EVICT_BATCH)).fetchall()
+            if not oldest:
+                break
+
+            for name, digest in oldest:
+                if self.__size() <= self.max_size:
+                    break
+                self.__db.execute("DELETE FROM entries WHERE name = ?",
+                                  (name,))
+
+                # Remove contents no longer referred to by any snapshot
+                if self.__db.execute("SELECT 1 FROM entries WHERE "
+                                     "digest = ?", (digest,)).fetchone():
+                    continue
+                size = self.__db.execute("SELECT size FROM blobs WHERE "
+                                         "digest = ?", (digest,)).fetchone()
+                try:
+                    os.remove(self.__blob_path(digest))
+                except OSError:
+                    pass
+                self.__db.execute("DELETE FROM blobs WHERE digest = ?",
+                                  (digest,))
+                self.__total -= size[0] if size else 0
+
+    def __blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".z")
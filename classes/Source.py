@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""This class represents a source of city bike snapshots: HSL's HTTP
+storage, a local folder of snapshot files, a zip or tar archive of
+snapshots or a folder of such archives. Functionality to list and read
+the snapshots are provided."""
+
+__author__ = "Joonas Häkkinen"
+
+import json
+import logging
+import os
+import re
+import sys
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import click
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from modules.metrics import count, in_context
+
+# Transient HTTP errors are retried this many times with backoff
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_TIMEOUT = 30
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+# Links in an HTTP index page, which is read this many bytes at a time
+LINK = re.compile(rb"""href\s*=\s*["']([^"']*)["']""", re.IGNORECASE)
+LISTING_CHUNK = 1024 ** 2
+
+
+class Source:
+    def __init__(self, path, threads=8, cache=None):
+        """Return a Source object for snapshots found in *path*.
+
+        *path* is an HTTP(S) address, a local folder containing
+        snapshot files and/or archives, or the path of a single zip or
+        tar(.gz) archive. Exits if *path* is none of these. Up to
+        *threads* remote files are fetched concurrently. Remote files
+        are looked up in *cache* (a SnapshotCache) before fetching.
+        """
+        self.path = path
+        self.threads = threads
+        self.cache = cache
+        self.remote = urlparse(path).scheme in ("http", "https")
+
+        if not (self.remote or os.path.isdir(path) or is_archive(path)):
+            logging.error("Invalid source path {}".format(path))
+            click.echo(click.style(" * Source path is not a valid HTTP "
+                                   "address, local folder or archive, "
+                                   "quitting.", fg="red", bold=True))
+            sys.exit()
+
+        self.__session = None
+        self.__listing = None
+        self.__locations = {}
+        self.__archives = {}
+        self.__locks = {}
+
+    def names(self):
+        """Return a list of all names (links, files or archive members)
+        found in this source.
+
+        Archive members are listed by their base name. Archives are
+        opened in parallel, one thread per archive.
+        """
+        if self.remote:
+            return self.__list_remote()
+
+        if is_archive(self.path):
+            archives = [self.path]
+            files = []
+        else:
+            entries = os.listdir(self.path)
+            archives = [os.path.join(self.path, entry) for entry in entries
+                        if is_archive(entry)]
+            files = [entry for entry in entries if not is_archive(entry)]
+
+        self.__locations = {name: (None, os.path.join(self.path, name))
+                            for name in files}
+
+        with ThreadPoolExecutor(max_workers=max(1, len(archives))) as pool:
+            for archive, members in zip(archives,
+                                        pool.map(self.__list_archive,
+                                                 archives)):
+                for name, member in members:
+                    self.__locations[name] = (archive, member)
+
+        return list(self.__locations)
+
+    def description(self):
+        """Return what names() lists, for messages to the user."""
+        if self.remote:
+            return "links"
+
+        return "files" if not self.__archives else "files and members"
+
+    def read(self, files):
+        """Return the contents of *files* in this source as bytes.
+
+        Remote and local files are fetched by a pool of *threads*
+        workers, remote ones sharing one HTTP session. Remote files
+        found in the cache are not fetched at all. Archive members are
+        read in parallel, one worker per archive. The result is in the
+        same order as *files*, with None in place of files that could
+        not be read.
+        """
+        if self.remote:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                return list(pool.map(in_context(self.__fetch), files))
+
+        groups = {}
+        for i, file in enumerate(files):
+            archive, _ = self.__locations.get(file, (None, None))
+            groups.setdefault(archive, []).append(i)
+
+        result = [None] * len(files)
+
+        def read_group(indices):
+            for i in indices:
+                result[i] = self.__read_local(files[i])
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            read_group = in_context(read_group)
+            futures = [pool.submit(read_group, [i])
+                       for i in groups.pop(None, [])]
+            futures += [pool.submit(read_group, indices)
+                        for indices in groups.values()]
+            for future in futures:
+                future.result()
+
+        count("read_bytes", sum(len(raw) for raw in result
+                                if raw is not None))
+        return result
+
+    def close(self):
+        """Close archives and cache opened by this source."""
+        for handle in self.__archives.values():
+            handle.close()
+
+        self.__archives = {}
+
+        if self.cache is not None:
+            self.cache.close()
+
+    def __fetch(self, file):
+        """Return contents of remote *file* or None if fetching fails."""
+        if self.cache is not None:
+            raw = self.cache.get(file)
+            if raw is not None:
+                count("cache_hits")
+                return raw
+
+        try:
+            url = self.path.rstrip("/") + "/" + file
+            res = self.__get_session().get(url, timeout=HTTP_TIMEOUT)
+            res.raise_for_status()
+        except RequestException as e:
+            logging.warning("Could not fetch {}: {}".format(file, e))
+            count("http_failures")
+            return None
+
+        count("http_requests")
+        count("http_bytes", len(res.content))
+
+        if self.cache is not None:
+            self.cache.put(file, res.content)
+
+        return res.content
+
+    def __list_remote(self):
+        """Return the links of the remote index page.
+
+        The page is read as a stream and links are picked out with a
+        regular expression. The last listing is kept (also in the
+        cache, if any) with the page's ETag and Last-Modified headers,
+        and the page is only downloaded again if the server reports it
+        changed.
+        """
+        cache_name = "listing " + self.path
+
+        if self.__listing is None and self.cache is not None:
+            raw = self.cache.get(cache_name)
+            if raw is not None:
+                self.__listing = json.loads(raw.decode("utf-8"))
+
+        headers = {}
+        if self.__listing is not None:
+            if self.__listing["etag"]:
+                headers["If-None-Match"] = self.__listing["etag"]
+            if self.__listing["last_modified"]:
+                headers["If-Modified-Since"] = self.__listing["last_modified"]
+
+        res = self.__get_session().get(self.path, headers=headers,
+                                       timeout=HTTP_TIMEOUT, stream=True)
+
+        if res.status_code == 304:
+            res.close()
+            logging.info("Source listing not modified, using the last one")
+            return list(self.__listing["names"])
+
+        res.raise_for_status()
+        names = []
+        rest = b""
+
+        for chunk in res.iter_content(LISTING_CHUNK):
+            # Links can be split between chunks, so only look up to the
+            # last complete tag
+            rest += chunk
+            end = rest.rfind(b">") + 1
+            names += [link.decode("utf-8")
+                      for link in LINK.findall(rest, 0, end)]
+            rest = rest[end:]
+
+        self.__listing = {"etag": res.headers.get("ETag"),
+                          "last_modified": res.headers.get("Last-Modified"),
+                          "names": names}
+
+        # Without either header the listing can't be validated later
+        if self.cache is not None and (self.__listing["etag"] or
+                                       self.__listing["last_modified"]):
+            self.cache.put(cache_name,
+                           json.dumps(self.__listing).encode("utf-8"))
+
+        return names
+
+    def __read_local(self, file):
+        """Return contents of local *file* or None if reading fails."""
+        archive, member = self.__locations.get(
+            file, (None, os.path.join(self.path, file)))
+
+        try:
+            if archive is None:
+                with open(member, "rb") as f:
+                    return f.read()
+
+            with self.__locks[archive]:
+                handle = self.__archives[archive]
+                if isinstance(handle, zipfile.ZipFile):
+                    return handle.read(member)
+                return handle.extractfile(member).read()
+        except (OSError, KeyError, zipfile.BadZipFile,
+                tarfile.TarError) as e:
+            logging.warning("Could not read {}: {}".format(file, e))
+            return None
+
+    def __list_archive(self, archive):
+        """Open *archive* and return (name, member info) tuples of the
+        snapshots in it.
+
+        The archive is kept open for reading. Members of tar archives
+        are read in the order they are stored, so reading batches in
+        time order only seeks forward in a compressed archive.
+        """
+        if zipfile.is_zipfile(archive):
+            handle = zipfile.ZipFile(archive)
+            members = [(os.path.basename(info.filename), info)
+                       for info in handle.infolist() if not info.is_dir()]
+        else:
+            handle = tarfile.open(archive)
+            members = [(os.path.basename(info.name), info)
+                       for info in handle.getmembers() if info.isfile()]
+
+        self.__archives[archive] = handle
+        self.__locks[archive] = threading.Lock()
+        return members
+
+    def __get_session(self):
+        """Return this source's HTTP session with a keep-alive
+        connection pool.
+
+        The pool holds a connection for each of *threads* and transient
+        errors (connection problems, 5xx responses) are retried with
+        exponential backoff. Retries are counted as 'http_retries'.
+        """
+        if self.__session is None:
+            retry = CountingRetry(total=HTTP_RETRIES,
+                                  backoff_factor=HTTP_BACKOFF,
+                                  status_forcelist=(500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.threads,
+                                  max_retries=retry)
+            self.__session = Session()
+            self.__session.mount("http://", adapter)
+            self.__session.mount("https://", adapter)
+
+        return self.__session
+
+
+class CountingRetry(Retry):
+    """Retry policy counting each failed attempt it handles as
+    'http_retries' (see modules.metrics.count()).
+    """
+
+    def increment(self, *args, **kwargs):
+        count("http_retries")
+        return super().increment(*args, **kwargs)
+
+
+def is_archive(path):
+    """Return True if *path* names a zip or tar archive."""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
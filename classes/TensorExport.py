@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""This class represents an export of the dataset as a dense (minute x
+station x feature) array of float32, for training models without
+pandas. The array is a raw file that can be memory-mapped with NumPy,
+and is appended to as new data arrives."""
+
+__author__ = "Joonas Häkkinen"
+
+import json
+import logging
+import os
+from os.path import isfile
+
+import click
+import numpy as np
+import pandas as pd
+
+from modules.schema import WEATHER_COLUMNS
+
+# Numeric columns of the schema exported as features, in order. Missing
+# values are exported as NaN and 'operative' as 0/1.
+FEATURES = ["avl_bikes", "free_slots", "total_slots", "operative", "lat",
+            "lon", "T", "WS_10MIN", "P_SEA", "R_1H"]
+
+# Files of an export: the array, its time axis (int64 nanoseconds since
+# the epoch, UTC) and metadata including the station order
+CUBE = "cube.f32"
+TIMES = "times.i8"
+META = "meta.json"
+
+# Station slots reserved in a new export. Stations are added in free
+# slots, and the file is rewritten with twice the slots when they run
+# out, so the station axis keeps its order.
+STATION_SLOTS = 256
+
+# Minutes copied at a time when rewriting the array
+COPY_CHUNK = 10000
+
+
+class TensorExport:
+    def __init__(self, directory):
+        """Open the export in *directory* or create it on first write.
+
+        Files left longer than the metadata says by an interrupted
+        append are cut back, so the export is always consistent.
+        """
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.meta = {"features": FEATURES, "stations": [],
+                     "slots": STATION_SLOTS, "minutes": 0, "last": None}
+
+        if isfile(self.__path(META)):
+            with open(self.__path(META)) as f:
+                self.meta = json.load(f)
+            self.__truncate()
+
+    def last_date(self):
+        """Return the date (UTC) of the last exported minute, or None."""
+        last = self.meta["last"]
+        return None if last is None else pd.Timestamp(last, tz="UTC")
+
+    def append(self, data):
+        """Append minutes of *data* after the last exported minute.
+
+        *data* is a DataFrame in the schema with a MultiIndex
+        (date_utc, name) in time order, e.g. a batch from update_data()
+        or a chunk from Datafile.query(). Earlier minutes are skipped.
+        """
+        dates = data.index.get_level_values(0)
+        if dates.tz is not None:
+            dates = dates.tz_convert(None)
+
+        keep = np.ones(len(data), dtype=bool)
+        if self.meta["last"] is not None:
+            keep = dates > pd.Timestamp(self.meta["last"])
+        if not keep.any():
+            return
+
+        data = data[keep]
+        minutes, rows = np.unique(dates[keep].values, return_inverse=True)
+        slots = self.__slots(data.index.get_level_values(1))
+
+        cube = np.full((len(minutes), self.meta["slots"], len(FEATURES)),
+                       np.nan, dtype=np.float32)
+        cube[rows, slots] = data[FEATURES].to_numpy(
+            dtype=np.float32, na_value=np.nan)
+
+        with open(self.__path(CUBE), "ab") as f:
+            f.write(cube.tobytes())
+        with open(self.__path(TIMES), "ab") as f:
+            f.write(minutes.astype("datetime64[ns]").astype(np.int64)
+                    .tobytes())
+
+        self.meta["minutes"] += len(minutes)
+        self.meta["last"] = str(pd.Timestamp(minutes[-1]))
+        self.__save_meta()
+
+        logging.info("Exported {:,} minutes to {}".format(
+            len(minutes), click.format_filename(self.directory)))
+
+    def fill_weather(self, weather):
+        """Fill in missing weather of exported minutes in place.
+
+        Missing weather of stations exported on a minute (those with
+        coordinates) is replaced with the values in *weather*, a
+        DataFrame indexed by date (UTC), like Datafile.fill_weather().
+        Other values are left as they are.
+        """
+        minutes = self.meta["minutes"]
+        if minutes == 0 or len(weather) == 0:
+            return
+
+        index = weather.index
+        if index.tz is not None:
+            index = index.tz_convert(None)
+
+        times = np.memmap(self.__path(TIMES), dtype=np.int64, mode="r",
+                          shape=(minutes,))
+        first = int(np.searchsorted(times, index.min().value))
+        if first == minutes:
+            return
+
+        dates = pd.DatetimeIndex(np.array(times[first:])
+                                 .view("datetime64[ns]"))
+        new = weather.set_axis(index).reindex(
+            index=dates, columns=WEATHER_COLUMNS).to_numpy(np.float32)
+        del times
+
+        cube = np.memmap(self.__path(CUBE), dtype=np.float32, mode="r+",
+                         shape=(minutes, self.meta["slots"], len(FEATURES)))
+        present = ~np.isnan(cube[first:, :, FEATURES.index("lat")])
+
+        for column, values in zip(WEATHER_COLUMNS, new.T):
+            part = cube[first:, :, FEATURES.index(column)]
+            missing = np.isnan(part) & present & \
+                ~np.isnan(values)[:, np.newaxis]
+            part[missing] = np.broadcast_to(values[:, np.newaxis],
+                                            part.shape)[missing]
+
+        cube.flush()
+        del cube
+
+    def catch_up(self, datafile):
+        """Append data in *datafile* (Datafile or DatafileSet) after
+        the last exported minute, a chunk at a time.
+        """
+        for chunk in datafile.query(start=self.last_date()):
+            self.append(chunk)
+
+    def __slots(self, names):
+        """Return station slots of *names*, adding new stations."""
+        stations = self.meta["stations"]
+        index = {name: slot for slot, name in enumerate(stations)}
+
+        for name in pd.unique(names):
+            if name not in index:
+                index[name] = len(stations)
+                stations.append(name)
+
+        if len(stations) > self.meta["slots"]:
+            slots = self.meta["slots"]
+            while slots < len(stations):
+                slots *= 2
+            self.__resize(slots)
+
+        return np.array([index[name] for name in names], dtype=np.int64)
+
+    def __resize(self, slots):
+        """Rewrite the array with *slots* station slots."""
+        minutes, old = self.meta["minutes"], self.meta["slots"]
+        path = self.__path(CUBE)
+
+        with open(path + ".tmp", "wb") as f:
+            if minutes > 0:
+                cube = np.memmap(path, dtype=np.float32, mode="r",
+                                 shape=(minutes, old, len(FEATURES)))
+                for start in range(0, minutes, COPY_CHUNK):
+                    part = cube[start:start + COPY_CHUNK]
+                    wide = np.full((len(part), slots, len(FEATURES)),
+                                   np.nan, dtype=np.float32)
+                    wide[:, :old] = part
+                    f.write(wide.tobytes())
+                del cube
+
+        os.replace(path + ".tmp", path)
+        self.meta["slots"] = slots
+        self.__save_meta()
+        logging.info("Export resized to {} station slots".format(slots))
+
+    def __truncate(self):
+        """Cut files back to the length recorded in the metadata."""
+        minutes = self.meta["minutes"]
+        sizes = {
+            CUBE: minutes * self.meta["slots"] * len(FEATURES) * 4,
+            TIMES: minutes * 8
+        }
+
+        for name, size in sizes.items():
+            path = self.__path(name)
+            if isfile(path) and os.path.getsize(path) > size:
+                logging.warning("Cutting interrupted export of {}"
+                                .format(name))
+                os.truncate(path, size)
+
+    def __save_meta(self):
+        path = self.__path(META)
+
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+        os.replace(path + ".tmp", path)
+
+    def __path(self, name):
+        return os.path.join(self.directory, name)
+
+
+def load_tensor(directory):
+    """Return an export in *directory* memory-mapped, without copying.
+
+    Returns a tuple (cube, times, stations, features): cube is a
+    read-only array of shape (minutes, stations, features), times the
+    datetime64[ns] (UTC) of each minute and stations and features lists
+    of names along the other axes.
+    """
+    with open(os.path.join(directory, META)) as f:
+        meta = json.load(f)
+
+    shape = (meta["minutes"], meta["slots"], len(meta["features"]))
+    if meta["minutes"] == 0:
+        cube = np.empty(shape, dtype=np.float32)
+        times = np.empty(0, dtype="datetime64[ns]")
+    else:
+        cube = np.memmap(os.path.join(directory, CUBE), dtype=np.float32,
+                         mode="r", shape=shape)
+        times = np.memmap(os.path.join(directory, TIMES), dtype=np.int64,
+                          mode="r", shape=(meta["minutes"],)) \
+            .view("datetime64[ns]")
+
+    return (cube[:, :len(meta["stations"])], times, meta["stations"],
+            meta["features"])
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""This class represents a local store of weather observations fetched
+from FMI. Format is HDF5. Observations are kept together with the time
+ranges already fetched, so only missing ranges need to be requested
+from FMI again."""
+
+__author__ = "Joonas Häkkinen"
+
+import logging
+import os
+from os.path import isfile
+
+import click
+import pandas as pd
+
+# Observations are recorded at 10-minute intervals, so ranges closer to
+# each other than this have no observations between them.
+RESOLUTION = pd.Timedelta(minutes=10)
+
+# Observations this recent may not be published yet and are not marked
+# as fetched
+SETTLE_TIME = pd.Timedelta(hours=1)
+
+
+class WeatherStore:
+    def __init__(self, path):
+        """Return a WeatherStore object for file in *path*, which is
+        created on first write.
+        """
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        self.__coverage = None
+
+    def gaps(self, start, stop):
+        """Return a list of (start, stop) ranges between *start* and
+        *stop* that have not been fetched yet.
+        """
+        start, stop = _naive(start), _naive(stop)
+        gaps = []
+
+        for covered_start, covered_stop in self.coverage():
+            if covered_stop < start or covered_start > stop:
+                continue
+            if covered_start > start:
+                gaps.append((start, covered_start))
+            start = max(start, covered_stop)
+
+        if start < stop:
+            gaps.append((start, stop))
+
+        return [(a, b) for a, b in gaps if b - a >= RESOLUTION]
+
+    def get(self, start, stop):
+        """Return stored observations between *start* and *stop* as a
+        DataFrame with a DatetimeIndex (UTC).
+        """
+        if not isfile(self.path):
+            return pd.DataFrame()
+
+        with pd.HDFStore(self.path, mode="r") as store:
+            if "/weather" not in store.keys():
+                return pd.DataFrame()
+
+            data = store.select("weather", where=[
+                'index >= "{}"'.format(_naive(start)),
+                'index <= "{}"'.format(_naive(stop))])
+
+        data.index = data.index.tz_localize("UTC")
+        return data
+
+    def add(self, data, start, stop):
+        """Store observations in *data* fetched for range *start* -
+        *stop* and mark that range as fetched.
+
+        Observations already in the store are skipped. Ranges reaching
+        closer to the present than SETTLE_TIME are only marked fetched
+        up to that point, so they will be completed later.
+        """
+        start, stop = _naive(start), _naive(stop)
+        stop = min(stop, _naive(pd.Timestamp.utcnow()) - SETTLE_TIME)
+
+        with pd.HDFStore(self.path, complevel=9, complib="zlib") as store:
+            if data is not None and len(data) > 0:
+                data = data.copy()
+                if data.index.tz is not None:
+                    data.index = data.index.tz_convert(None)
+                data = data.astype(float)
+
+                if "/weather" in store.keys():
+                    known = store.select_column("weather", "index")
+                    data = data[~data.index.isin(known)]
+                    columns = store.get_storer("weather").non_index_axes
+                    data = data.reindex(columns=columns[0][1])
+
+                if len(data) > 0:
+                    data.index.name = "date_utc"
+                    store.append("weather", data.sort_index(),
+                                 format="table")
+
+            if start < stop:
+                self.__coverage = _merge(self.coverage() + [(start, stop)])
+                store.put("coverage", pd.DataFrame(
+                    self.__coverage, columns=["start", "stop"]))
+
+        logging.info("Stored weather for {} - {} in {}"
+                     .format(start, stop, click.format_filename(self.path)))
+
+    def coverage(self):
+        """Return a sorted list of (start, stop) ranges fetched so far."""
+        if self.__coverage is None:
+            self.__coverage = []
+
+            if isfile(self.path):
+                with pd.HDFStore(self.path, mode="r") as store:
+                    if "/coverage" in store.keys():
+                        coverage = store["coverage"]
+                        self.__coverage = list(zip(coverage.start,
+                                                   coverage.stop))
+
+        return self.__coverage
+
+
+def _merge(ranges):
+    """Merge overlapping or adjacent (start, stop) *ranges*."""
+    merged = []
+
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1] + RESOLUTION:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    return merged
+
+
+def _naive(date):
+    """Return *date* as a time zone naive (UTC) Timestamp."""
+    date = pd.Timestamp(date)
+    return date.tz_convert(None) if date.tz is not None else date
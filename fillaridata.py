@@ -13,7 +13,15 @@ from appdirs import user_log_dir
 
 from classes.Config import Config
 from classes.Datafile import Datafile
-from modules.data import update_data
+from classes.DatafileSet import DatafileSet, is_datafile_set
+from classes.SnapshotCache import SnapshotCache
+from classes.TensorExport import TensorExport
+from classes.WeatherStore import WeatherStore
+from modules.data import follow_data, update_data
+from modules.fmi import ALIGN_POLICIES
+from modules.metrics import MetricsRecorder
+from modules.query import FORMATS, write_query
+from modules.schema import COLUMNS
 
 
 # Global options
@@ -23,7 +31,13 @@ from modules.data import update_data
 @click.option("--logfile", "-l", type=click.Path(),
               default="fillaridata.log",
               help="Path to log file.")
-def cli(file, logfile):
+@click.option("--storage", type=click.Choice(["dense", "delta"]),
+              default="dense", help="How station data is stored in a new "
+              "data file: every row (dense) or only changes (delta).")
+@click.option("--partition", type=click.Choice(["day", "week", "month"]),
+              default=None, help="Store data in a directory (--file) "
+              "with one data file per period.")
+def cli(file, logfile, storage, partition):
     """Initialise program with given parameters."""
     global df, config
 
@@ -42,8 +56,11 @@ def cli(file, logfile):
         new_key = click.prompt("Please enter your API key", type=str)
         config.set("FMI", "api_key", new_key)
 
-    # Load the datafile
-    df = Datafile(file)
+    # Load the datafile, or a set of them if partitioned
+    if partition is not None or is_datafile_set(file):
+        df = DatafileSet(file, partition or "month", storage)
+    else:
+        df = Datafile(file, storage)
 
 
 # COMMAND: update
@@ -55,14 +72,153 @@ def cli(file, logfile):
                                                  "file at this interval.")
 @click.option("--source", "-s", type=click.Path(),
               default="http://dev.hsl.fi/tmp/citybikes/",
-              help="Path to source data.")
+              help="Path to source data: URL, folder or zip/tar archive.")
 @click.option("--first", type=str, default="2016-01-01 00:00:00",
               help="First timestamp to include, format: %Y-%m-%d- %H:%M:%S")
-def update(limit, batch, source, first):
-    update_data(df, config, first, limit, batch, source)
+@click.option("--threads", "-t", default=8,
+              help="Number of source files to fetch concurrently.")
+@click.option("--workers", "-w", default=1,
+              help="Number of processes parsing source files.")
+@click.option("--cache-dir", type=click.Path(), default=None,
+              help="Cache downloaded source files in this folder.")
+@click.option("--cache-size", default=2048,
+              help="Size limit of the cache in megabytes.")
+@click.option("--weather-file", type=click.Path(),
+              default="~/.fillaridata/weather.h5",
+              help="Store weather data fetched from FMI in this file. Use "
+                   "an empty value to disable.")
+@click.option("--weather-policy", type=click.Choice(ALIGN_POLICIES),
+              default="nearest",
+              help="How weather observations are aligned to minutes: "
+                   "nearest observation, latest observation before the "
+                   "minute (asof) or interpolated.")
+@click.option("--export-dir", type=click.Path(), default=None,
+              help="Keep a tensor export (see 'export') in this folder up "
+                   "to date.")
+@click.option("--queue-depth", default=2,
+              help="Number of batches waiting between the fetch, weather "
+                   "and write stages. Bounds memory use.")
+@click.option("--metrics-file", type=click.Path(),
+              default="fillaridata-metrics.jsonl",
+              help="Append per-batch metrics (JSON lines) to this file. Use "
+                   "an empty value to disable.")
+@click.option("--profile", is_flag=True,
+              help="Profile batches and save cProfile and tracemalloc "
+                   "data of the slowest one next to the metrics file.")
+def update(limit, batch, source, first, threads, workers, cache_dir,
+           cache_size, weather_file, weather_policy, export_dir, queue_depth,
+           metrics_file, profile):
+    cache = None
+    if cache_dir is not None:
+        cache = SnapshotCache(cache_dir, cache_size * 1024 ** 2)
+
+    weather_store = WeatherStore(weather_file) if weather_file else None
+
+    export = TensorExport(export_dir) if export_dir is not None else None
+
+    metrics = None
+    if metrics_file:
+        metrics = MetricsRecorder(metrics_file, profile)
+
+    update_data(df, config, first, limit, batch, source, threads, workers,
+                cache, weather_store, export, queue_depth, metrics,
+                weather_policy)
+
+
+# COMMAND: follow
+@cli.command(help="Keep data file up to date, polling for new data until "
+                  "interrupted.")
+@click.option("--source", "-s", type=click.Path(),
+              default="http://dev.hsl.fi/tmp/citybikes/",
+              help="Path to source data: URL, folder or zip/tar archive.")
+@click.option("--interval", "-i", default=60,
+              help="Seconds between polls for new data.")
+@click.option("--threads", "-t", default=8,
+              help="Number of source files to fetch concurrently.")
+@click.option("--weather-file", type=click.Path(),
+              default="~/.fillaridata/weather.h5",
+              help="Store weather data fetched from FMI in this file. Use "
+                   "an empty value to disable.")
+@click.option("--weather-policy", type=click.Choice(ALIGN_POLICIES),
+              default="nearest",
+              help="How weather observations are aligned to minutes: "
+                   "nearest observation, latest observation before the "
+                   "minute (asof) or interpolated.")
+@click.option("--export-dir", type=click.Path(), default=None,
+              help="Keep a tensor export (see 'export') in this folder up "
+                   "to date.")
+def follow(source, interval, threads, weather_file, weather_policy,
+           export_dir):
+    weather_store = WeatherStore(weather_file) if weather_file else None
+    export = TensorExport(export_dir) if export_dir is not None else None
+
+    if export is not None:
+        export.catch_up(df)
+
+    follow_data(df, config, source, interval, threads, weather_store, export,
+                weather_policy)
 
 
 # COMMAND: info
 @cli.command(help="Show information about current data file.")
 def info():
     df.print_info()
+
+
+# COMMAND: migrate
+@cli.command(help="Convert an old data file to the current format.")
+def migrate():
+    df.migrate()
+
+
+# COMMAND: export
+@cli.command(help="Export data as a (minute x station x feature) array for "
+                  "memory-mapping with NumPy.")
+@click.option("--output", "-o", type=click.Path(), default="./tensor",
+              help="Export folder, created or brought up to date.")
+def export(output):
+    tensor = TensorExport(output)
+    tensor.catch_up(df)
+    click.echo(click.style(" * Exported {:,} minutes of {:,} stations to {}"
+                           .format(tensor.meta["minutes"],
+                                   len(tensor.meta["stations"]),
+                                   click.format_filename(output)),
+                           fg="green"))
+
+
+# COMMAND: rollup
+@cli.command(help="Rebuild hourly and daily per-station rollups.")
+def rollup():
+    df.rebuild_rollups()
+    click.echo(click.style(" * Rollups rebuilt.", fg="green"))
+
+
+# COMMAND: query
+@cli.command(help="Write data of selected dates, stations and columns to a "
+                  "file.")
+@click.option("--start", type=str, default=None,
+              help="First timestamp (UTC) to include.")
+@click.option("--stop", type=str, default=None,
+              help="Last timestamp (UTC) to include.")
+@click.option("--station", "stations", multiple=True,
+              help="Station name to include, can be repeated. Default: all.")
+@click.option("--column", "columns", multiple=True,
+              type=click.Choice([column for column, _ in COLUMNS]),
+              help="Column to include, can be repeated. Default: all.")
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default="csv",
+              help="Output format.")
+@click.option("--output", "-o", type=click.Path(), default="-",
+              help="Output file, '-' for standard output.")
+def query(start, stop, stations, columns, fmt, output):
+    unknown = set(stations) - set(df.stations().name) if stations else ()
+    if unknown:
+        click.echo(click.style(" * No data for stations: {}".format(
+            ", ".join(sorted(unknown))), fg="yellow"))
+
+    chunks = df.query(start, stop, list(stations) or None,
+                      list(columns) or None)
+    rows = write_query(chunks, output, fmt)
+
+    if output != "-":
+        click.echo(click.style(" * Wrote {:,} rows to {}".format(
+            rows, click.format_filename(output)), fg="green"))
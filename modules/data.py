@@ -6,27 +6,57 @@ Fillariennustin. """
 __author__ = "Joonas Häkkinen"
 
 import logging
-import os
 import re
 import sys
-from urllib.parse import urlparse
+import time
 
 import click
 import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
-from requests import get
 
-from modules.fmi import add_weather_data
+from classes.Journal import Journal
+from classes.Source import Source
+from classes.WeatherStore import RESOLUTION, SETTLE_TIME
+from modules.fmi import add_weather_data, weather_for
+from modules.metrics import BatchMetrics, count
+from modules.pipeline import run_pipeline
+from modules.schema import FACT_COLUMNS, apply_schema
+from modules.snapshots import (chunks_to_frame, new_pool, parse_snapshots,
+                               parse_snapshots_parallel)
 
 
-def update_data(datafile, config, first, limit, batch, source):
+# Names of snapshot files, with their date and time (UTC)
+SNAPSHOT_NAME = re.compile(r"stations_(\d{8}T\d{6})Z")
+
+# Longest gap after the stored data filled with missing rows by follow,
+# see __generate_missing_rows()
+FOLLOW_MAX_GAP = pd.Timedelta(hours=6)
+
+
+def update_data(datafile, config, first, limit, batch, source, threads=8,
+                workers=1, cache=None, weather_store=None, export=None,
+                depth=2, metrics=None, weather_policy="nearest"):
     """Updates the datafile with new data.
 
     Data after the last entry in *datafile* is fetched and appended to
     the file. Data is saved to file at *batch* intervals to limit
     memory use.
 
+    Batches go through a pipeline (see modules.pipeline) of three
+    stages: fetching bike data, adding weather and writing, so the next
+    batch is fetched while the previous ones are being enriched and
+    written. Batches are written in order, and at most *depth* batches
+    wait between two stages.
+
+    Missing rows are generated from the end of the data already stored
+    (or fetched) on, so minutes missing between batches get rows too,
+    unless *first* is after the stored data. Gaps longer than *batch*
+    minutes (e.g. outages of the source) are logged and left unfilled.
+
+    Batches with weather are staged in the datafile's Journal until
+    written. Batches staged by an interrupted update are written first,
+    so they aren't fetched again.
+
     Note that 'date' refers to a unique value of date, which are
     recorded at 1-minute intervals (i.e., an hour has 60 such 'dates').
 
@@ -35,60 +65,330 @@ def update_data(datafile, config, first, limit, batch, source):
     :param limit: Number of maximum dates to add.
     :param batch: How many dates to process at between saving the
     datafile.
-    :param source: URL or local path to a folder containing source data
-    files named in the format above.
+    :param source: URL, local path to a folder containing source data
+    files named in the format above (or archives of such files) or path
+    to a single zip or tar(.gz) archive.
+    :param threads: Number of source files fetched concurrently.
+    :param workers: Number of processes parsing source files, 1 parses
+    in the main process.
+    :param cache: SnapshotCache instance for remote source files, or
+    None.
+    :param weather_store: WeatherStore instance for weather data
+    fetched from FMI, or None.
+    :param export: TensorExport instance kept up to date with the
+    datafile, or None.
+    :param depth: Number of batches waiting between pipeline stages.
+    :param metrics: MetricsRecorder instance recording each batch's
+    stage times, I/O and row counts, or None.
+    :param weather_policy: How weather is aligned to minutes, see
+    modules.fmi.weather_for().
     :return: None
     """
     api_key = config.value("FMI", "api_key")
+    journal = Journal(datafile.path)
+    __resume_staged(datafile, journal, export)
+
+    source = Source(source, threads, cache)
+
+    filenames = __get_filenames(source, datafile.last_date(), first)
+    batches = __trim_split_filenames(filenames, limit, batch)
+
+    max_gap = pd.Timedelta(minutes=batch)
+    tail = None
+    if first is None or _naive(first) <= _naive(datafile.last_date()):
+        tail = __stored_tail(datafile)
+
+    if export is not None:
+        export.catch_up(datafile)
+
+    pool = new_pool(workers)
+
+    def fetch(filenames):
+        nonlocal tail
+        batch = metrics.batch() if metrics is not None else BatchMetrics(0)
+        new_data = batch.run("fetch", __get_bike_data, source, filenames,
+                             pool, workers)
+        batch.set(files=len(filenames), rows_in=len(new_data),
+                  first=new_data.index.levels[0].min(),
+                  last=new_data.index.levels[0].max())
+        new_data = batch.run("missing_rows", __generate_missing_rows,
+                             new_data, tail, max_gap)
+        tail = __tail(new_data)
+        return batch, new_data
+
+    def enrich(fetched):
+        batch, new_data = fetched
+        new_data = batch.run("weather", add_weather_data, new_data, api_key,
+                             weather_store, None, weather_policy)
+        new_data = apply_schema(new_data)
+        return batch, journal.stage(new_data), new_data
+
+    def write(staged):
+        batch, name, new_data = staged
+        batch.run("write", datafile.update, new_data)
+        if export is not None:
+            batch.run("export", export.append, new_data)
+        journal.done(name)
+
+        batch.set(rows_out=len(new_data))
+        if metrics is not None:
+            metrics.finish(batch)
+
+    try:
+        run_pipeline(batches, [fetch, enrich, write], depth)
+    finally:
+        source.close()
+        if pool is not None:
+            pool.shutdown()
+        if metrics is not None:
+            metrics.close()
+
+    return None
+
 
-    filenames = __get_filenames(source, datafile.last_date())
-    batches = __trim_split_filenames(filenames, first, limit, batch)
+def follow_data(datafile, config, source, interval=60, threads=8,
+                weather_store=None, export=None, weather_policy="nearest"):
+    """Keep the datafile up to date until interrupted.
 
-    for filenames in batches:
-        new_data = __get_bike_data(source, filenames)
-        new_data = __generate_missing_rows(new_data)
-        new_data = add_weather_data(new_data, api_key)
-        datafile.update(new_data)
+    Polls *source* every *interval* seconds and appends each new
+    snapshot as soon as it's found, keeping the source's connections
+    and the datafile open between polls. Weather not yet published for
+    the new minutes is stored as missing and filled in on later polls,
+    until the minutes are older than SETTLE_TIME. The delay from each
+    snapshot's time to writing it (lag) and rows written per second are
+    logged.
+
+    :param datafile: Datafile instance
+    :param config: Config instance
+    :param source: Source data, see update_data().
+    :param interval: Seconds between polls.
+    :param threads: Number of source files fetched concurrently.
+    :param weather_store: WeatherStore instance, or None.
+    :param export: TensorExport instance kept up to date, or None.
+    :param weather_policy: See update_data().
+    :return: None
+    """
+    api_key = config.value("FMI", "api_key")
+    source = Source(source, threads)
+    listing = None
+    missing_weather = None
+
+    click.echo(click.style(" * Following {}, press Ctrl-C to stop"
+                           .format(source.path), fg="green"))
+
+    try:
+        while True:
+            started = time.time()
+
+            try:
+                listing = __follow_snapshots(datafile, source, listing,
+                                             api_key, weather_store, export,
+                                             weather_policy)
+
+                if missing_weather is None:
+                    missing_weather = __first_missing_weather(datafile)
+                if missing_weather is not None:
+                    missing_weather = __fill_weather(
+                        datafile, missing_weather, api_key, weather_store,
+                        weather_policy, export)
+            except Exception as e:
+                # Keep following, the next poll will try again
+                logging.error("Follow: poll failed: {!r}".format(e))
+
+            time.sleep(max(0, interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        click.echo(click.style(" * Stopped following.", fg="green"))
+    finally:
+        source.close()
 
     return None
 
 
-def __get_filenames(source, start_after):
+def __follow_snapshots(datafile, source, listing, api_key, weather_store,
+                       export, weather_policy):
+    """Append snapshots in *source* newer than the datafile.
+
+    Returns the source's listing parsed (see __update_listing()), to be
+    passed to the next call as *listing*.
+    """
+    listing = __update_listing(source.names(), listing)
+    filenames = __since(*listing, datafile.last_date())
+
+    if not filenames:
+        return listing
+
+    started = time.time()
+    new_data = __get_bike_data(source, filenames)
+    new_data = __generate_missing_rows(new_data, __stored_tail(datafile),
+                                       FOLLOW_MAX_GAP)
+    if len(new_data) == 0:
+        return listing
+    new_data = add_weather_data(new_data, api_key, weather_store,
+                                RESOLUTION / 2, weather_policy)
+    new_data = apply_schema(new_data)
+    datafile.update(new_data)
+    if export is not None:
+        export.append(new_data)
+
+    elapsed = time.time() - started
+    lag = pd.Timestamp.utcnow() - new_data.index.levels[0].max()
+    logging.info("Follow: {} snapshots, {:,} rows in {:.1f} s ({:,.0f} "
+                 "rows/s), lag {:.0f} s".format(
+                     len(filenames), len(new_data), elapsed,
+                     len(new_data) / max(elapsed, 1e-3),
+                     lag.total_seconds()))
+
+    return listing
+
+
+def __first_missing_weather(datafile):
+    """Return the first of the latest minutes in *datafile* missing
+    weather (UTC), or None.
+    """
+    if datafile.metadata() is None:
+        return None
+
+    last = datafile.last_date()
+    recent = datafile.select(last - SETTLE_TIME, last, columns=["T"])
+
+    if recent is None or not recent["T"].isna().any():
+        return None
+
+    first = recent.index.get_level_values(0)[recent["T"].isna()].min()
+    return first.tz_localize("UTC") if first.tz is None else first
+
+
+def __fill_weather(datafile, start, api_key, weather_store, weather_policy,
+                   export=None):
+    """Fill in weather of minutes from *start* on published since they
+    were written, in *datafile* and *export* (TensorExport or None).
+    Returns the first minute still missing weather, or None if there's
+    none or it's too old to wait for.
+    """
+    start = pd.Timestamp(start)
+    if start.tz is None:
+        start = start.tz_localize("UTC")
+
+    stop = pd.Timestamp.utcnow()
+    weather = weather_for(pd.date_range(start, stop, freq="min"), api_key,
+                          weather_store, RESOLUTION / 2, weather_policy)
+    missing = datafile.fill_weather(weather, start)
+    if export is not None:
+        export.fill_weather(weather)
+
+    if missing is not None and missing < stop - SETTLE_TIME:
+        logging.warning("Follow: no weather published for {}, giving up"
+                        .format(missing))
+        return None
+
+    return missing
+
+
+def __parse_listing(names):
+    """Return snapshot names in *names* and their dates, sorted by date.
+
+    Names not of the form 'stations_yyyymmddThhmmssZ' are dropped.
+    Dates are parsed in one pass and returned as an array of
+    datetime64 (UTC), so ranges can be found by binary search.
+    """
+    matches = [(match.group(1), name) for match, name in
+               ((SNAPSHOT_NAME.match(name), name) for name in names)
+               if match is not None]
+
+    if not matches:
+        return np.array([], dtype=object), np.array([], dtype="M8[ns]")
+
+    stamps, names = zip(*matches)
+    dates = pd.to_datetime(list(stamps), format="%Y%m%dT%H%M%S").values
+    order = np.argsort(dates, kind="mergesort")
+
+    return np.array(names, dtype=object)[order], dates[order]
+
+
+def __update_listing(names, listing=None):
+    """Return *listing*, names and dates from __parse_listing(), with
+    the snapshots in *names* later than its last one added.
+
+    Only the new names are parsed, so polling a long listing that
+    rarely changes stays cheap.
+    """
+    if listing is None or len(listing[0]) == 0:
+        return __parse_listing(names)
+
+    # Dates in names have a fixed width, so names sort like their dates
+    known, dates = listing
+    last = known[-1]
+    added, added_dates = __parse_listing([name for name in names
+                                          if name > last])
+
+    return (np.concatenate([known, added]),
+            np.concatenate([dates, added_dates]))
+
+
+def __since(names, dates, start_after=None, first=None):
+    """Return names with dates (see __parse_listing()) later than
+    *start_after* and not before *first*, as a list.
+    """
+    start = 0
+
+    if start_after is not None:
+        start = dates.searchsorted(_naive(start_after).to_datetime64(),
+                                   side="right")
+    if first is not None:
+        start = max(start, dates.searchsorted(
+            _naive(first).to_datetime64(), side="left"))
+
+    return list(names[start:])
+
+
+def __resume_staged(datafile, journal, export=None):
+    """Write batches staged in *journal* by an interrupted update.
+
+    Batches already in *datafile* (written but not yet marked done) are
+    dropped.
+    """
+    staged = journal.staged()
+
+    if staged:
+        click.echo(" * Resuming {} staged batches".format(len(staged)))
+        logging.info("Resuming {} staged batches".format(len(staged)))
+
+    for name in staged:
+        new_data = journal.load(name)
+
+        if new_data.index.get_level_values(0).max() > datafile.last_date():
+            datafile.update(new_data)
+            if export is not None:
+                export.append(new_data)
+
+        journal.done(name)
+
+
+def __get_filenames(source, start_after, first=None):
     """Return a list of filenames for fetching new data.
 
-    Returns a list of filenames parsed from *source*. Only names of the
-    form 'stations_yyyymmddThhmmssZ' and corresponding to a date and
-    time later than *start_after* are included.
+    Returns a list of filenames parsed from *source*, sorted by date.
+    Only names of the form 'stations_yyyymmddThhmmssZ' and
+    corresponding to a date and time later than *start_after* and not
+    before *first* are included.
 
     Arguments:
-    source -- URL or local path to a folder containing source data files
-    named in the format above.
+    source -- Source instance.
     start_after -- The date and time (UTC) of the last row in an
     existing datafile.
+    first -- First date and time (UTC) to include (--first), or None.
     """
 
     # Form the list of source files
-    if urlparse(source).scheme == "http":
-        links = BeautifulSoup(get(source).content, "lxml").find_all("a")
-        names = [link['href'] for link in links]
-        msg = "links"
-    elif os.path.isdir(source):
-        names = os.listdir(source)
-        msg = "files"
-    else:
-        logging.error("Invalid source path {}".format(source))
-        click.echo(click.style(" * Source path is not a valid HTTP address "
-                               "or local folder, quitting.", fg="red",
-                               bold=True))
-        sys.exit()
+    names = source.names()
+    msg = source.description()
 
     click.echo(click.style(" * {:,} {} found".format(len(names), msg),
                            fg="green"))
 
     # Check that all filenames match the date format we expect
     # (N.B.: trailing 'Z' denotes UTC time
-    matches = [name for name in names if re.match("stations_\d{8}T\d{6}Z",
-                                                  name)]
+    matches, dates = __parse_listing(names)
 
     if len(matches) > 1:
         click.echo(click.style(" * {:,} filenames are in correct format"
@@ -101,7 +401,7 @@ def __get_filenames(source, start_after):
         sys.exit()
 
     # Return only new filenames
-    due = [f for f in matches if pd.to_datetime(f[9:]) > start_after]
+    due = __since(matches, dates, start_after, first)
 
     if len(due) == 0:
         logging.info("No new files found, quitting.")
@@ -111,84 +411,146 @@ def __get_filenames(source, start_after):
     return due
 
 
-def __get_bike_data(source, files):
+def __get_bike_data(source, files, pool=None, workers=1):
     """Merge and return citybike data.
 
-    Citybike data located in *files in *source* directory is fetched,
-    merged and preprocessed for use as Fillariennustin project's
-    dataset.
+    Citybike data located in *files* in *source* (a Source instance) is
+    fetched, merged and preprocessed for use as Fillariennustin
+    project's dataset. The result is in timestamp order. If process
+    *pool* (with *workers* processes) is given, the files are parsed in
+    that pool.
     """
-    data = pd.DataFrame()
-    failures = 0
-
-    for file in files:
-        full_path = os.path.join(source, file)
-
-        try:
-            new_data = pd.read_json(full_path)
-            new_data = new_data.result.apply(pd.Series)
-            new_data['date_utc'] = pd.Timestamp(file[9:]).replace(second=0)
-            new_data.set_index(['date_utc', 'name'], inplace=True)
-            data = data.append(new_data)
-        except:
-            failures += 1
-            continue
+    files = sorted(files)
+    snapshots = source.read(files)
+    fetched = [(file, raw) for file, raw in zip(files, snapshots)
+               if raw is not None]
+
+    if pool is None:
+        chunk, failed = parse_snapshots(fetched)
+        chunks = [chunk]
+    else:
+        chunks, failed = parse_snapshots_parallel(fetched, pool, workers)
 
+    for file, reason in failed:
+        logging.warning("Could not parse {}: {}".format(file, reason))
+
+    failures = len(files) - len(fetched) + len(failed)
+    count("failed_files", failures)
     if failures > 0:
         logging.warning("{} failures in __get_bike_data()".format(failures))
         click.echo(click.style(" * Data for {} dates could not be "
                                "processed".format(failures), fg="red",
                                bold=True))
 
-    return data
+    return chunks_to_frame(chunks)
 
 
-def __trim_split_filenames(filenames, first, limit, batch):
-    """Apply --first, --limit and --batch options to list of filenames.
+def __trim_split_filenames(filenames, limit, batch):
+    """Apply --limit and --batch options to list of filenames.
 
-    Takes a list of filenames and applies the mentioned command line
-    options to that list. Entries corresponding to timestamps before
-    *first* are dropped and the list is truncated to maximum length of
-    *limit*. The resulting list is then split into lists containing at
-    maximum *batch* members and the resulting list of lists is
-    returned.
+    Takes a list of filenames (--first is applied by __get_filenames())
+    and truncates it to maximum length of *limit*. The resulting list
+    is then split into lists containing at maximum *batch* members and
+    the resulting list of lists is returned.
 
     :param filenames: List of properly formatted filenames.
-    :param first: First timestamp to include in result.
     :param limit: Maximum number of filenames in result.
     :param batch: Size limit for sublists.
     :return: List of lists of filename strings.
     """
 
-    # Apply --first option by dropping earlier filenames
-    date_format = "stations_%Y%m%dT%H%M%SZ"
-    filenames = \
-        [f for f in filenames
-            if pd.to_datetime(f, format=date_format) >= pd.to_datetime(first)]
-
     # Apply --limit option by truncating the list of filenames
     if limit > 0:
-        last = limit if limit < len(filenames) else len(filenames)
-        filenames = filenames[:last]
+        filenames = filenames[:limit]
 
     # Split to batches (--batch)
     return [filenames[x:x + batch] for x in range(0, len(filenames), batch)]
 
 
-def __generate_missing_rows(data):
+def __generate_missing_rows(data, tail=None, max_gap=None):
     """Generate missing rows to ensure *data* has a row for each minute.
 
+    Rows are generated for each minute and station in *data* and, if
+    *tail* is given, for the minutes between the stored data and
+    *data* and for the stations that had data on the last stored
+    minute, so consecutive batches join up. Rows not after the stored
+    data are dropped. If the gap between the stored data and *data* is
+    longer than *max_gap* (Timedelta), it's logged and left unfilled, so
+    an outage of the source doesn't turn into a batch of missing rows.
+    The rows are placed on the new grid by position, without
+    reindexing.
+
     :param: data: Pandas DataFrame with a proper MultiIndex.
+    :param: tail: Tuple (date, names) of the last stored minute and the
+    stations with data on it, or None.
+    :param: max_gap: Longest gap filled after *tail*, or None.
     :return: Input dataframe appended with missing rows.
     """
-
-    start = data.index.min()[0]
-    stop = data.index.max()[0]
+    dates = data.index.get_level_values(0)
+    names = data.index.get_level_values(1)
+    start, stop = dates.min(), dates.max()
+    stations = names.unique().sort_values()
+
+    if tail is not None:
+        last, tail_names = tail
+        if max_gap is None or start - last <= max_gap:
+            start = last + pd.Timedelta(minutes=1)
+        else:
+            logging.warning("No data between {} and {}, gap not filled"
+                            .format(last, start))
+        stations = stations.union(tail_names)
 
     # New index
     date_utc = pd.date_range(start, stop, freq="min")
-    name = data.index.levels[1].values
-    new_index = pd.MultiIndex.from_product([date_utc, name],
+    new_index = pd.MultiIndex.from_product([date_utc, stations],
                                            names=["date_utc", "name"])
 
-    return data.reindex(index=new_index)
\ No newline at end of file
+    # Position of each row on the grid, rows before it are dropped
+    minute = date_utc.get_indexer(dates)
+    keep = minute >= 0
+    position = minute[keep] * len(stations) + \
+        stations.get_indexer(names[keep])
+
+    columns = {}
+    for column in data.columns:
+        values = data[column].to_numpy()[keep]
+        if values.dtype.kind == "f":
+            grid = np.full(len(new_index), np.nan, dtype=values.dtype)
+        elif values.dtype.kind in "iu":
+            grid = np.full(len(new_index), np.nan)
+        else:
+            grid = np.full(len(new_index), np.nan, dtype=object)
+        grid[position] = values
+        columns[column] = grid
+
+    return pd.DataFrame(columns, index=new_index, columns=data.columns)
+
+
+def __stored_tail(datafile):
+    """Return the tail (see __tail()) of the data in *datafile*, or
+    None if it's empty.
+    """
+    if datafile.metadata() is None:
+        return None
+
+    last = datafile.last_date()
+    _, names = __tail(datafile.select(last, last, columns=FACT_COLUMNS))
+    return last, names
+
+
+def __tail(data):
+    """Return (date, names) of the last minute in *data* and the
+    stations with data on it, see __generate_missing_rows().
+    """
+    dates = data.index.get_level_values(0)
+    last = dates.max()
+    present = (dates == last) & \
+        data[FACT_COLUMNS].notna().any(axis=1).to_numpy()
+
+    return last, list(data.index.get_level_values(1)[present])
+
+
+def _naive(date):
+    """Return *date* as a time zone naive (UTC) Timestamp."""
+    date = pd.Timestamp(date)
+    return date.tz_convert(None) if date.tz is not None else date
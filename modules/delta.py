@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""Change-only ('delta') storage of station data for Fillariennustin.
+
+In delta mode a station's row is only stored when its values change.
+Missing rows (minutes the station was not reported) are stored as a row
+of missing values, which marks a gap until the next change. Stations
+that drop out of the data altogether are marked with a row of ABSENT,
+and have no rows at all until their next stored row. On the
+first stored minute of each UTC day, rows of all stations are stored as
+a keyframe, so the state at any date can be rebuilt from the rows of
+that day alone.
+
+Station data here is in the storage types of modules.schema, with a
+MultiIndex (date_utc, station_id). """
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from modules.schema import FACT_COLUMNS
+
+# Marks a station absent from the data from the row's date on
+ABSENT = -2
+
+# Marks stations with no stored state in encode()
+__UNSET = np.iinfo(np.int16).min
+
+
+def encode(facts, state, last_date=None):
+    """Return the rows of *facts* that need to be stored.
+
+    Returns a tuple (changes, state), where changes holds the rows that
+    differ from the station's previous row, keyframe rows and ABSENT
+    markers for stations in *state* missing from *facts* altogether,
+    and state is the updated last stored row of each station.
+
+    Arguments:
+    facts -- Dense station data (a row for each station and minute) in
+    time order.
+    state -- DataFrame of the last stored values of each station,
+    indexed by station_id.
+    last_date -- Date of the last stored minute, or None.
+    """
+    data = facts.reset_index()
+    dates = data.date_utc.values
+
+    # Keyframes on the first stored minute of each day
+    minutes = np.unique(dates)
+    days = minutes.astype("datetime64[D]")
+    previous = np.empty_like(days)
+    previous[0] = np.datetime64("NaT") if last_date is None else \
+        pd.Timestamp(last_date).to_datetime64().astype("datetime64[D]")
+    previous[1:] = days[:-1]
+    data["keyframe"] = np.isin(dates, minutes[days != previous])
+
+    data = data.sort_values(["station_id", "date_utc"], kind="mergesort")
+    ids = data.station_id.values
+    values = data[FACT_COLUMNS].to_numpy(dtype=np.int16)
+
+    # Compare each row to the previous one of the same station, or to
+    # the stored state for a station's first row
+    first = np.ones(len(data), dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    before = np.empty_like(values)
+    before[1:] = values[:-1]
+    before[first] = state.reindex(ids[first])[FACT_COLUMNS] \
+        .fillna(__UNSET).to_numpy(dtype=np.int16)
+
+    keep = (values != before).any(axis=1) | data.keyframe.values
+    changes = data[keep].drop(columns="keyframe")
+
+    # Stations that disappeared get an absence marker
+    absent = state[~state.index.isin(ids) & (state[FACT_COLUMNS] !=
+                                             ABSENT).any(axis=1)]
+    markers = pd.DataFrame(ABSENT, index=absent.index,
+                           columns=FACT_COLUMNS).reset_index()
+    markers["date_utc"] = minutes[0]
+
+    changes = pd.concat([changes, markers], sort=False)
+    changes = changes.sort_values(["date_utc", "station_id"],
+                                  kind="mergesort")
+    changes = changes.set_index(["date_utc", "station_id"])
+    changes = changes.astype({column: facts[column].dtype
+                              for column in FACT_COLUMNS})
+
+    # New state: the last stored row of each station
+    last = data.drop_duplicates("station_id", keep="last") \
+        .set_index("station_id")[FACT_COLUMNS]
+    state = pd.concat([state[~state.index.isin(last.index)], last])
+    state.loc[absent.index, FACT_COLUMNS] = ABSENT
+    state.index.name = "station_id"
+
+    return changes, state.astype(np.int16).sort_index()
+
+
+def empty_state():
+    """Return a state for encode() with no stations."""
+    return pd.DataFrame(columns=FACT_COLUMNS, dtype=np.int16,
+                        index=pd.Index([], dtype=np.int16,
+                                       name="station_id"))
+
+
+def decode(changes, minutes):
+    """Rebuild dense station data from stored *changes*.
+
+    Returns a row for each minute in *minutes* and each station with a
+    stored row on or before that minute, carrying the station's last
+    stored values forward. Stations are left out while their last
+    stored row is an ABSENT marker. *changes* must start on a keyframe (the
+    first stored minute of a day), or rows before the range's first
+    change of each station are left out.
+
+    Arguments:
+    changes -- Stored rows in time order.
+    minutes -- Sorted DatetimeIndex of stored minutes to rebuild.
+    """
+    data = changes.reset_index()
+    ids, columns = np.unique(data.station_id.values, return_inverse=True)
+    rows = minutes.searchsorted(data.date_utc.values)
+    inside = rows < len(minutes)
+
+    # Index of the last stored row of each station on each minute
+    last = np.full((len(minutes), len(ids)), -1, dtype=np.int32)
+    last[rows[inside], columns[inside]] = np.arange(len(data),
+                                                    dtype=np.int32)[inside]
+    last = np.maximum.accumulate(last, axis=0)
+
+    minute, station = np.nonzero(last >= 0)
+    rows = last[minute, station]
+    absent = (data[FACT_COLUMNS].to_numpy() == ABSENT).all(axis=1)[rows]
+    minute, station, rows = minute[~absent], station[~absent], rows[~absent]
+    dense = data[FACT_COLUMNS].iloc[rows]
+    dense.index = pd.MultiIndex.from_arrays(
+        [minutes[minute], ids[station]], names=["date_utc", "station_id"])
+
+    return dense
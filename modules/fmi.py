@@ -5,38 +5,135 @@ Institute) open data service. """
 
 __author__ = "Joonas Häkkinen"
 
+import logging
+import os
+import threading
+import time
 import xml.etree.ElementTree as ET
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
 
+import click
+import numpy as np
 import pandas as pd
 from owslib.wfs import WebFeatureService
+from requests import Timeout
 
+from classes.WeatherStore import RESOLUTION
+from modules.metrics import count, in_context
 
-def add_weather_data(data, api_key):
+# Weather parameters recorded and Helsinki's coordinates in FMI's data
+PARAMETERS = ("T", "WS_10MIN", "P_SEA", "R_1H")
+HELSINKI = "60.17523 24.94459"
+
+# XML namespaces and tags of FMI's GML responses
+MEMBER_TAG = "{http://www.opengis.net/wfs/2.0}member"
+BSWFS_NS = "{http://xml.fmi.fi/schema/wfs/2.0}"
+GML_NS = "{http://www.opengis.net/gml/3.2}"
+
+# Address of FMI's WFS. Can be overridden with environment variable
+# FILLARIDATA_WFS_URL (e.g. to use a local stub in benchmarks).
+WFS_URL = "http://data.fmi.fi/fmi-apikey/{api_key}/wfs"
+
+# Requests to FMI's WFS running at once
+WFS_WORKERS = 4
+WFS_TIMEOUT = 60
+
+# Limits for the adaptive request window. FMI serves at most 7 days per
+# request. The window grows while responses take less than FAST_RESPONSE
+# seconds and shrinks on timeouts.
+MAX_WINDOW = pd.Timedelta(days=7)
+MIN_WINDOW = pd.Timedelta(hours=1)
+FAST_RESPONSE = 10
+
+# Failed requests are retried this many times with exponential backoff
+WFS_RETRIES = 4
+WFS_BACKOFF = 2
+
+# How observations are aligned to minutes, see weather_for()
+ALIGN_POLICIES = ("nearest", "asof", "interpolate")
+
+# One WebFeatureService per API key, see __get_service()
+__services = {}
+__services_lock = threading.Lock()
+
+
+def add_weather_data(data, api_key, store=None, tolerance=None,
+                     policy="nearest"):
     """Add weather data from FMI to DataFrame.
 
     This module looks for the first and last dates in given DataFrame's
-    DatetimeIndex and fetches weather data from FMI for that period.
-    The weather data is then appended to the original data and the
-    resulting DataFrame returned.
+    MultiIndex and fetches weather data from FMI for that period. The
+    weather is aligned once per unique date (the first level of the
+    index) and broadcast to the rows of each date by their codes in
+    that level, and the resulting DataFrame returned.
 
     Arguments:
-    data -- Pandas DataFrame with a DatetimeIndex.
+    data -- Pandas DataFrame with a MultiIndex (date_utc, name).
     api_key -- API key to FMI's open data service.
+    store -- WeatherStore instance. If given, only weather missing from
+    the store is fetched from FMI.
+    tolerance -- See weather_for().
+    policy -- See weather_for().
     """
+    weather_data = weather_for(data.index.levels[0], api_key, store,
+                               tolerance, policy)
 
-    # Get weather data for the range
-    start = data.index.min()[0]
-    stop = data.index.max()[0]
+    # Broadcast weather of each date to all rows of that date
+    codes = data.index.codes[0]
+    data = data.copy(deep=False)
+    for column in weather_data.columns:
+        data[column] = weather_data[column].to_numpy()[codes]
 
-    weather_data = __get_weather_data(start, stop, "1d", api_key)
+    return data
 
-    # Concatenate weather data to all rows of original data
-    weather_data = weather_data.reindex(data.index.get_level_values(0),
-                                        method="nearest")
-    weather_data.index = data.index
-    data = pd.concat([data, weather_data], axis=1)
 
-    return data
+def weather_for(dates, api_key, store=None, tolerance=None,
+                policy="nearest"):
+    """Return weather data from FMI for each date in *dates*.
+
+    Returns a DataFrame indexed by *dates* with the observation of each
+    date chosen by *policy*: the nearest observation ('nearest'), the
+    latest observation at or before the date ('asof') or interpolated
+    in time between the observations before and after it
+    ('interpolate'). If *tolerance* (Timedelta) is given, dates with no
+    observation that close get missing values, e.g. dates after the
+    latest published observation.
+
+    Arguments:
+    dates -- Unique DatetimeIndex (UTC).
+    api_key -- API key to FMI's open data service.
+    store -- WeatherStore instance, see add_weather_data().
+    tolerance -- Maximum distance to the nearest observation, or None.
+    policy -- One of ALIGN_POLICIES.
+    """
+    if policy not in ALIGN_POLICIES:
+        raise ValueError("Unknown weather alignment policy: {}"
+                         .format(policy))
+
+    # Start one observation early, so the first dates have an
+    # observation before them ('asof' and 'interpolate' need one)
+    weather_data = __get_weather_data(dates.min() - RESOLUTION, dates.max(),
+                                      "1d", api_key, store)
+
+    if policy == "nearest":
+        return weather_data.reindex(dates, method="nearest",
+                                    tolerance=tolerance)
+    if policy == "asof":
+        return weather_data.reindex(dates, method="ffill",
+                                    tolerance=tolerance)
+
+    # Interpolate between observations, but don't extrapolate past them
+    aligned = weather_data.reindex(weather_data.index.union(dates)) \
+        .interpolate(method="time", limit_area="inside").reindex(dates)
+    if tolerance is not None:
+        far = weather_data.index.get_indexer(dates, method="nearest",
+                                             tolerance=tolerance) < 0
+        aligned.loc[far] = np.nan
+
+    return aligned
 
 
 def __get_weather_range(start, stop, api_key):
@@ -49,7 +146,7 @@ def __get_weather_range(start, stop, api_key):
     Maximum interval between *start* and *stop* is 168 hrs = 7 days.
     However, intervals over 1-2 days tend to experience HTTP timeouts.
 
-    Returns None, if getting data from WFS fails.
+    Exceptions raised by the WFS request are passed on to the caller.
 
     Arguments:
     start -- First date (Pandas Timestamp)
@@ -57,85 +154,110 @@ def __get_weather_range(start, stop, api_key):
     api_key -- API key to FMI's open data service.
     """
 
-    # Connect to FMI WFS service and load raw GML data
-    addr = "http://data.fmi.fi/fmi-apikey/" + api_key + '/wfs'
+    # Load raw GML data from FMI WFS service
     query_id = "fmi::observations::weather::cities::simple"
     start = pd.Timestamp(start).strftime("%Y-%m-%dT%H:%M:%SZ")
     stop = pd.Timestamp(stop).strftime("%Y-%m-%dT%H:%M:%SZ")
     params = {'starttime': str(start), 'endtime': str(stop)}
 
-    try:
-        wfs = WebFeatureService(addr, version="2.0.0")
-        res = wfs.getfeature(storedQueryID=query_id, storedQueryParams=params)
-    except TimeoutError:
-        print("timeout")
-        return None
-    except:
-        print("muu")
-        return None
-
-    data = pd.DataFrame()
-    targets = ['T', 'WS_10MIN', 'P_SEA', 'R_1H']
-    row_data = {}
-
-    # Parse through the tree structure toward target data
-    root = ET.fromstring(res.read())
-    for member in root.findall("{http://www.opengis.net/wfs/2.0}member"):
-        bs = member.find("{http://xml.fmi.fi/schema/wfs/2.0}BsWfsElement")
-        location = bs.find("{http://xml.fmi.fi/schema/wfs/2.0}Location")
-        point = location.find("{http://www.opengis.net/gml/3.2}Point")
-        pos = point.find("{http://www.opengis.net/gml/3.2}pos")
-
-        # Limit to Helsinki's coordinates (note trailing space)
-        if pos.text == "60.17523 24.94459 ":
-            pname = bs.find(
-                "{http://xml.fmi.fi/schema/wfs/2.0}ParameterName").text
-            pvalue = float(bs.find(
-                "{http://xml.fmi.fi/schema/wfs/2.0}ParameterValue").text)
-
-            # Parse parameter values
-            if pname in targets:
-                row_data[pname] = pvalue
-
-            # Once all parameters have been recorded, update the DataFrame
-            if len(row_data) == len(targets):
-                date = pd.Timestamp(
-                    bs.find("{http://xml.fmi.fi/schema/wfs/2.0}Time").text)
-                row = pd.DataFrame(row_data, index=[date])
-                data = data.append(row)
-                row_data = {}
+    wfs = __get_service(api_key)
+    count("wfs_requests")
+    res = wfs.getfeature(storedQueryID=query_id, storedQueryParams=params)
 
-    return data
+    return __parse_weather(res)
 
 
-def __get_weather_data(start, stop, step, api_key):
-    """Executes __get_weather_range() in given intervals.
+def __parse_weather(res):
+    """Parse Helsinki's observations from WFS response *res*.
 
-    Note that for FMI, the maximum interval that can be fetched at once
-    is 7 days. You may experience HTTP read timeouts before that. The
-    original author was able to use only up to '2d' interval, with '1d'
-    appearing to be a robust selection.
+    The GML is parsed incrementally: each observation (BsWfsElement) is
+    checked for Helsinki's coordinates first, its value stored in a
+    typed array and the element freed. The DataFrame is built once at
+    the end, with one row per observation time and NaN for parameters
+    that were not observed at that time.
+
+    Arguments:
+    res -- File-like WFS response.
+    """
+    raw = res.read()
+    count("wfs_bytes", len(raw))
+    source = BytesIO(raw if isinstance(raw, bytes) else raw.encode())
+
+    times = []
+    rows = {}
+    values = {name: array("d") for name in PARAMETERS}
+    root = None
+
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event != "end":
+            continue
+
+        if elem.tag == BSWFS_NS + "BsWfsElement":
+            # Limit to Helsinki's coordinates
+            pos = elem.findtext(BSWFS_NS + "Location/" + GML_NS +
+                                "Point/" + GML_NS + "pos")
+            name = elem.findtext(BSWFS_NS + "ParameterName")
+
+            if pos is not None and pos.strip() == HELSINKI and \
+                    name in values:
+                date = elem.findtext(BSWFS_NS + "Time")
+
+                if date not in rows:
+                    rows[date] = len(times)
+                    times.append(date)
+                    for column in values.values():
+                        column.append(np.nan)
+
+                values[name][rows[date]] = float(
+                    elem.findtext(BSWFS_NS + "ParameterValue"))
+        elif elem.tag == MEMBER_TAG:
+            # Free observations that have been processed
+            root.clear()
+
+    index = pd.DatetimeIndex(pd.to_datetime(times, utc=True))
+    return pd.DataFrame({name: np.array(column, dtype=np.float64)
+                         for name, column in values.items()},
+                        index=index, columns=list(PARAMETERS))
+
+
+def __get_weather_data(start, stop, step, api_key, store=None,
+                       workers=WFS_WORKERS):
+    """Get weather data between start and stop.
+
+    Without a *store*, the whole range is fetched from FMI. With one,
+    only the ranges missing from the store are fetched and added to it,
+    and the result is read from the store. See __fetch_ranges() for how
+    the ranges are fetched.
 
     Arguments:
     start -- First date (Pandas Timestamp)
     stop -- Last date (Pandas Timestamp)
-    step -- Interval length, use the format for pandas.date_range()'s
-    freq argument (e.g., '1d' for one day).
+    step -- Initial length of a single request, use the format for
+    pandas.Timedelta (e.g., '1d' for one day).
     api_key -- API key to FMI's open data service.
+    store -- WeatherStore instance or None.
+    workers -- Maximum number of requests running at once.
     """
-    data = pd.DataFrame()
     start = pd.Timestamp(start)
     # Add 10 minutes to stopping time to cover for any rounding
     stop = pd.Timestamp(stop) + pd.Timedelta(minutes=10)
 
-    for range_start in pd.date_range(start, stop, freq=step):
-        range_stop = range_start + pd.Timedelta(step)
+    ranges = [(start, stop)] if store is None else store.gaps(start, stop)
+    frames = []
 
-        if range_stop > stop:
-            range_stop = stop
+    for range_start, range_stop, range_data in __fetch_ranges(
+            ranges, api_key, step, workers):
+        if store is None:
+            frames.append(range_data)
+        else:
+            store.add(range_data, range_start, range_stop)
 
-        data = data.append(__get_weather_range(range_start, range_stop,
-                                               api_key))
+    if store is None:
+        data = pd.concat(frames).sort_index() if frames else pd.DataFrame()
+    else:
+        data = store.get(start, stop)
 
     """1-hour rain (R_1H) is recorded only on the hour. If this source 
    is used when making predictions, the data available will reflect 
@@ -147,3 +269,110 @@ def __get_weather_data(start, stop, step, api_key):
     data.R_1H.fillna(method="bfill", inplace=True)
 
     return data[~data.index.duplicated(keep="first")]
+
+
+def __fetch_ranges(ranges, api_key, window, workers=WFS_WORKERS):
+    """Fetch weather data for (start, stop) *ranges* from FMI.
+
+    Up to *workers* requests run at once, sharing one WFS connection.
+    Ranges are cut into requests of length *window*, which is doubled
+    (up to MAX_WINDOW) after fast responses and halved (down to
+    MIN_WINDOW) on timeouts, when the timed out request is also split
+    in two. Failed requests are retried with exponential backoff.
+
+    Yields (start, stop, data) tuples in order of completion. If a
+    request still fails after WFS_RETRIES retries, the remaining
+    requests are completed and the program exits.
+    """
+    todo = deque(ranges)
+    window = pd.Timedelta(window)
+    attempts = {}
+    running = {}
+    failed = []
+
+    timed_range = in_context(__timed_range)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while todo or running:
+            while todo and len(running) < workers:
+                start, stop = todo.popleft()
+                if stop - start > window:
+                    todo.appendleft((start + window, stop))
+                    stop = start + window
+
+                tries = attempts.get((start, stop), 0)
+                delay = WFS_BACKOFF * 2 ** (tries - 1) if tries > 0 else 0
+                future = executor.submit(timed_range, start, stop, api_key,
+                                         delay)
+                running[future] = (start, stop)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                start, stop = running.pop(future)
+
+                try:
+                    data, elapsed = future.result()
+                except (Timeout, TimeoutError) as e:
+                    count("wfs_timeouts")
+                    window = max(window / 2, MIN_WINDOW)
+                    error = e
+
+                    if stop - start > MIN_WINDOW:
+                        middle = (start + (stop - start) / 2).floor("min")
+                        todo.appendleft((middle, stop))
+                        todo.appendleft((start, middle))
+                        continue
+                except Exception as e:
+                    error = e
+                else:
+                    if elapsed < FAST_RESPONSE:
+                        window = min(window * 2, MAX_WINDOW)
+                    yield start, stop, data
+                    continue
+
+                tries = attempts.get((start, stop), 0) + 1
+                logging.warning("Weather request {} - {} failed ({}/{}): {}"
+                                .format(start, stop, tries, WFS_RETRIES,
+                                        repr(error)))
+
+                if tries > WFS_RETRIES:
+                    failed.append((start, stop))
+                else:
+                    count("wfs_retries")
+                    attempts[(start, stop)] = tries
+                    todo.appendleft((start, stop))
+
+    if failed:
+        logging.error("Could not fetch weather data for {}".format(failed))
+        click.echo(click.style(" * Fetching weather data from FMI failed, "
+                               "quitting.", fg="red", bold=True))
+        raise SystemExit
+
+
+def __timed_range(start, stop, api_key, delay):
+    """Run __get_weather_range() after *delay* seconds.
+
+    Returns a tuple of the data and the time the request took.
+    """
+    time.sleep(delay)
+    began = time.monotonic()
+    data = __get_weather_range(start, stop, api_key)
+
+    return data, time.monotonic() - began
+
+
+def __get_service(api_key):
+    """Return a WebFeatureService for *api_key*.
+
+    The service is connected (GetCapabilities requested) only once and
+    shared between requests and threads.
+    """
+    with __services_lock:
+        if api_key not in __services:
+            addr = os.environ.get("FILLARIDATA_WFS_URL", WFS_URL) \
+                .format(api_key=api_key)
+            __services[api_key] = WebFeatureService(addr, version="2.0.0",
+                                                    timeout=WFS_TIMEOUT)
+
+        return __services[api_key]
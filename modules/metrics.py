@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""Run-time metrics of Fillariennustin's update.
+
+Code doing I/O adds to named counters with count() (e.g. HTTP requests
+and bytes), from any thread. BatchMetrics times the stages of one batch
+and counts what its stages do: while a stage runs, count() also adds to
+the stage's own counters, found through a context variable. Stages of
+different batches run in different threads at the same time, so each
+sees only its own counts. Work a stage hands to a thread pool is
+counted for the stage if submitted through in_context(). Each finished
+batch is written to a JSON-lines file. """
+
+__author__ = "Joonas Häkkinen"
+
+import contextvars
+import cProfile
+import json
+import logging
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+import pandas as pd
+
+__counters = Counter()
+__lock = threading.Lock()
+
+# Counters of the stage running in the current context, see BatchMetrics
+_stage_counters = contextvars.ContextVar("stage_counters", default=None)
+
+# Only one profiler can run at a time, so profiled stages take turns
+_profile_lock = threading.Lock()
+
+
+def count(name, n=1):
+    """Add *n* to counter *name*, and to the counters of the stage
+    running in this context, if any.
+    """
+    stage = _stage_counters.get()
+
+    with __lock:
+        __counters[name] += n
+        if stage is not None:
+            stage[name] += n
+
+
+def in_context(function):
+    """Return *function* wrapped to run in the caller's context, so
+    count() in another thread (e.g. in a thread pool) adds to the
+    counters of the caller's stage.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can be entered by one thread at a time
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+
+def counters():
+    """Return a copy of all counters."""
+    with __lock:
+        return dict(__counters)
+
+
+def peak_rss():
+    """Return the peak memory use (RSS) of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class BatchMetrics:
+    def __init__(self, batch, profile=False):
+        """Return metrics of batch number *batch*.
+
+        With *profile*, each stage is also run under cProfile (see
+        MetricsRecorder for how profiles are kept). Profiled stages
+        don't overlap, so profiling slows down pipelined updates.
+        """
+        self.batch = batch
+        self.profile = profile
+        self.values = {"batch": batch, "stages": {}}
+        self.counters = Counter()
+        self.profiles = []
+
+    def run(self, stage, function, *args):
+        """Return *function*(*args*), recording its wall time as stage
+        *stage* together with what it counted.
+        """
+        stage_counters = Counter()
+        token = _stage_counters.set(stage_counters)
+        started = time.perf_counter()
+        profiler = cProfile.Profile() if self.profile else None
+
+        if profiler is not None:
+            _profile_lock.acquire()
+            profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                _profile_lock.release()
+                self.profiles.append(profiler)
+
+            self.values["stages"][stage] = round(
+                time.perf_counter() - started, 4)
+            _stage_counters.reset(token)
+            self.counters.update(stage_counters)
+
+    def set(self, **values):
+        """Record *values* (e.g. row counts) of this batch."""
+        self.values.update(values)
+
+    def total(self):
+        """Return the wall time of all stages of this batch."""
+        return sum(self.values["stages"].values())
+
+
+class MetricsRecorder:
+    def __init__(self, path, profile=False):
+        """Write metrics of finished batches to JSON-lines file *path*.
+
+        With *profile*, memory allocations are traced and the cProfile
+        statistics and a tracemalloc snapshot of the slowest batch are
+        written next to *path* ('.prof' and '.tracemalloc') when closed.
+        """
+        self.path = path
+        self.profile = profile
+        self.__batches = 0
+        self.__slowest = None
+        self.__snapshot = None
+
+        if profile:
+            tracemalloc.start()
+
+    def batch(self):
+        """Return BatchMetrics for the next batch."""
+        self.__batches += 1
+        return BatchMetrics(self.__batches, self.profile)
+
+    def finish(self, metrics):
+        """Write *metrics* (BatchMetrics) of a finished batch.
+
+        'peak_rss_mb' is the peak memory use of the process so far, not
+        of the batch: batches overlap in the pipeline, so their memory
+        use can't be told apart. Use --profile for allocations of the
+        slowest batch.
+        """
+        entry = dict(metrics.values)
+        entry.update(metrics.counters)
+        entry["time"] = pd.Timestamp.utcnow().isoformat()
+        entry["seconds"] = round(metrics.total(), 4)
+        entry["peak_rss_mb"] = round(peak_rss(), 1)
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+
+        logging.info("Batch {}: {}".format(metrics.batch, ", ".join(
+            "{} {:.1f} s".format(stage, seconds)
+            for stage, seconds in metrics.values["stages"].items())))
+
+        if self.profile and (self.__slowest is None or
+                             metrics.total() > self.__slowest.total()):
+            self.__slowest = metrics
+            self.__snapshot = tracemalloc.take_snapshot()
+
+    def close(self):
+        """Write profiles of the slowest batch, if profiling."""
+        if not self.profile:
+            return
+
+        if self.__slowest is not None and self.__slowest.profiles:
+            stats = pstats.Stats(self.__slowest.profiles[0])
+            for profiler in self.__slowest.profiles[1:]:
+                stats.add(profiler)
+            stats.dump_stats(self.path + ".prof")
+            self.__snapshot.dump(self.path + ".tracemalloc")
+
+            logging.info("Profile of slowest batch ({}, {:.1f} s) written "
+                         "to {}.prof".format(self.__slowest.batch,
+                                             self.__slowest.total(),
+                                             self.path))
+
+        tracemalloc.stop()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""A small staged pipeline for Fillariennustin.
+
+Each stage runs in its own thread and hands its results to the next one
+through a bounded queue, so stages work on consecutive items at the
+same time (e.g. fetching batch N+1 while batch N is written) while at
+most *depth* items wait between any two stages. Items pass every stage
+in order. """
+
+__author__ = "Joonas Häkkinen"
+
+import logging
+import queue
+import threading
+
+# Marks the end of items in a queue
+__DONE = object()
+
+# Seconds between checks for a failed stage while waiting on a queue
+__POLL = 0.1
+
+
+def run_pipeline(items, stages, depth=2):
+    """Pass each of *items* through the functions in *stages* in order.
+
+    The result of each stage is given to the next one; results of the
+    last stage are dropped. If a stage raises an exception (including
+    SystemExit), the other stages stop after their current item and the
+    exception is raised here. Items already through the last stage stay
+    done.
+
+    Arguments:
+    items -- Iterable of inputs to the first stage.
+    stages -- List of functions taking one argument.
+    depth -- Maximum number of items waiting between two stages.
+    """
+    queues = [queue.Queue(maxsize=depth) for _ in stages]
+    stop = threading.Event()
+    errors = []
+
+    def run(stage, inbox, outbox):
+        try:
+            while True:
+                item = __get(inbox, stop)
+                if item is __DONE:
+                    break
+
+                result = stage(item)
+
+                if outbox is not None and not __put(outbox, result, stop):
+                    return
+        except BaseException as e:
+            logging.error("Pipeline stage {} failed: {!r}"
+                          .format(stage.__name__, e))
+            errors.append(e)
+            stop.set()
+            return
+
+        if outbox is not None:
+            __put(outbox, __DONE, stop)
+
+    threads = [threading.Thread(target=run, name=stage.__name__, daemon=True,
+                                args=(stage, queues[i],
+                                      queues[i + 1] if i + 1 < len(stages)
+                                      else None))
+               for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for item in items:
+            if not __put(queues[0], item, stop):
+                break
+        __put(queues[0], __DONE, stop)
+
+        for thread in threads:
+            thread.join()
+    finally:
+        # Also stops the stages if interrupted
+        stop.set()
+
+    if errors:
+        raise errors[0]
+
+
+def __put(q, item, stop):
+    """Put *item* in *q*, or return False if *stop* is set first."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=__POLL)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def __get(q, stop):
+    """Return the next item in *q*, or __DONE if *stop* is set first."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=__POLL)
+        except queue.Empty:
+            continue
+
+    return __DONE
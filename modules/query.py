@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""Writing results of Datafile.query() to files for Fillariennustin.
+
+Results arrive in chunks, and each chunk is appended to the output as
+soon as it's read, so queries of any size run in the memory of one
+chunk. """
+
+__author__ = "Joonas Häkkinen"
+
+import logging
+
+import click
+import pandas as pd
+
+from modules.schema import to_storage
+
+FORMATS = ("csv", "parquet", "hdf")
+
+# Space reserved for strings in HDF5 output, which can't grow once the
+# table is created
+HDF_ITEMSIZE = {"name": 64, "style": 32}
+
+
+def write_query(chunks, path, fmt="csv"):
+    """Write DataFrames in *chunks* to *path* in format *fmt*.
+
+    Returns the number of rows written.
+
+    Arguments:
+    chunks -- Iterable of DataFrames with the same columns, e.g. from
+    Datafile.query().
+    path -- Output file, or '-' for standard output (CSV only).
+    fmt -- One of FORMATS.
+    """
+    if path == "-" and fmt != "csv":
+        click.echo(click.style(" * Only CSV can be written to standard "
+                               "output.", fg="red", bold=True))
+        raise SystemExit
+
+    writer = {"csv": __write_csv, "parquet": __write_parquet,
+              "hdf": __write_hdf}[fmt]
+    rows = writer(chunks, path)
+
+    logging.info("Wrote {:,} rows of query results to {}"
+                 .format(rows, click.format_filename(path)))
+    return rows
+
+
+def __write_csv(chunks, path):
+    rows = 0
+
+    with click.open_file(path, "w") as f:
+        for chunk in chunks:
+            chunk.to_csv(f, header=rows == 0)
+            rows += len(chunk)
+
+    return rows
+
+
+def __write_parquet(chunks, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        click.echo(click.style(" * Writing Parquet requires pyarrow: "
+                               "pip install pyarrow", fg="red", bold=True))
+        raise SystemExit
+
+    rows = 0
+    writer = None
+
+    try:
+        for chunk in chunks:
+            if writer is None:
+                table = pa.Table.from_pandas(chunk)
+                writer = pq.ParquetWriter(path, table.schema)
+            else:
+                table = pa.Table.from_pandas(chunk, schema=writer.schema)
+
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
+
+
+def __write_hdf(chunks, path):
+    rows = 0
+
+    with pd.HDFStore(path, mode="w", complevel=9, complib="zlib") as store:
+        for chunk in chunks:
+            chunk = to_storage(chunk)
+            itemsize = {column: size for column, size in HDF_ITEMSIZE.items()
+                        if column in chunk.columns or
+                        column in chunk.index.names}
+            store.append("data", chunk, format="table",
+                         min_itemsize=itemsize)
+            rows += len(chunk)
+
+    return rows
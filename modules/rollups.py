@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""Hourly and daily per-station rollups of the Fillariennustin dataset.
+
+Rollups are stored as mergeable aggregates (counts, sums, minimums and
+maximums) rather than means, so the rollup of a period split between
+two batches is the merge of the two batches' rollups. Means are only
+computed when reading, see summarize(). Station aggregates are indexed
+by (period, station_id) and weather aggregates, which are the same for
+all stations, by period. """
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from modules.schema import MISSING, WEATHER_COLUMNS
+
+# Rollups kept in the data file: name and length of period
+ROLLUPS = {"hourly": "h", "daily": "D"}
+
+# How station aggregates are merged
+STATION_AGGREGATES = {
+    "minutes": "sum",
+    "avl_sum": "sum",
+    "avl_min": "min",
+    "avl_max": "max",
+    "empty_minutes": "sum",
+    "full_minutes": "sum"
+}
+
+
+def aggregate(facts, weather, freq):
+    """Return station and weather aggregates of *facts* and *weather*
+    per period of length *freq*.
+
+    Returns a tuple (stations, weather) of DataFrames, see the module
+    docstring.
+
+    Arguments:
+    facts -- Dense station data in storage types (missing values are
+    MISSING), with a MultiIndex (date_utc, station_id).
+    weather -- Weather per minute, indexed by date_utc.
+    freq -- Period length, e.g. 'h' for hours.
+    """
+    dates = facts.index.get_level_values(0)
+    bikes = facts["avl_bikes"].to_numpy()
+    valid = bikes != MISSING
+
+    frame = pd.DataFrame({
+        "period": dates.floor(freq),
+        "station_id": facts.index.get_level_values(1),
+        "minutes": valid.astype(np.int32),
+        "avl_sum": np.where(valid, bikes, 0).astype(np.int32),
+        "avl_min": np.where(valid, bikes, np.nan).astype(np.float32),
+        "avl_max": np.where(valid, bikes, np.nan).astype(np.float32),
+        "empty_minutes": (bikes == 0).astype(np.int32),
+        "full_minutes": (facts["free_slots"].to_numpy() == 0)
+        .astype(np.int32)
+    })
+    stations = frame.groupby(["period", "station_id"], sort=True) \
+        .agg(STATION_AGGREGATES)
+
+    return __typed_stations(stations), aggregate_weather(weather, freq)
+
+
+def aggregate_weather(weather, freq):
+    """Return weather aggregates of *weather* (indexed by date_utc) per
+    period of length *freq*, see aggregate().
+    """
+    values = weather[WEATHER_COLUMNS].astype(np.float64)
+    periods = values.index.floor(freq)
+    weather = pd.concat([values.groupby(periods).sum().add_suffix("_sum"),
+                         values.groupby(periods).count().add_suffix("_n")],
+                        axis=1)
+    weather.index.name = "period"
+
+    return __typed_weather(weather)
+
+
+def merge(stations, weather):
+    """Merge lists of aggregates of the same periods.
+
+    Returns a tuple (stations, weather) with one row per period (and
+    station).
+
+    Arguments:
+    stations -- List of station aggregates.
+    weather -- List of weather aggregates.
+    """
+    stations = pd.concat(stations).groupby(level=[0, 1], sort=True) \
+        .agg(STATION_AGGREGATES)
+    weather = pd.concat(weather).groupby(level=0, sort=True).sum()
+
+    return __typed_stations(stations), __typed_weather(weather)
+
+
+def summarize(stations, weather):
+    """Return readable rollups of aggregates *stations* and *weather*.
+
+    Returns a DataFrame indexed by (period, station_id) with the number
+    of minutes with data, mean, minimum and maximum available bikes,
+    minutes the station was empty or full, and the mean of each
+    weather column.
+    """
+    result = pd.DataFrame({
+        "minutes": stations.minutes,
+        "avl_mean": (stations.avl_sum /
+                     stations.minutes.where(stations.minutes > 0))
+        .astype(np.float32),
+        "avl_min": stations.avl_min,
+        "avl_max": stations.avl_max,
+        "empty_minutes": stations.empty_minutes,
+        "full_minutes": stations.full_minutes
+    }, index=stations.index)
+
+    periods = stations.index.get_level_values(0)
+    for column in WEATHER_COLUMNS:
+        mean = weather[column + "_sum"] / \
+            weather[column + "_n"].where(weather[column + "_n"] > 0)
+        result[column] = mean.reindex(periods).to_numpy(np.float32)
+
+    return result
+
+
+def __typed_stations(stations):
+    """Return station aggregates with counts and sums as int32 and
+    minimums and maximums as float32 (NaN if no data).
+    """
+    return stations.astype({column: np.float32 if how in ("min", "max")
+                            else np.int32
+                            for column, how in STATION_AGGREGATES.items()})
+
+
+def __typed_weather(weather):
+    """Return weather aggregates with sums as float64 and counts as
+    int32.
+    """
+    for column in WEATHER_COLUMNS:
+        weather[column + "_sum"] = weather[column + "_sum"] \
+            .astype(np.float64)
+        weather[column + "_n"] = weather[column + "_n"].astype(np.int32)
+
+    return weather[[column + suffix for column in WEATHER_COLUMNS
+                    for suffix in ("_sum", "_n")]]
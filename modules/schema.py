@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""Schema of the Fillariennustin dataset: column types in memory and in
+the data file, and conversions between the two. """
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+# Version of the data file layout, stored in the file's metadata.
+# 1: table format with float columns, 2: typed columns below, 3: station,
+# fact and weather tables stored separately.
+SCHEMA_VERSION = 3
+
+# In-memory types of the dataset's columns, in order. Station names are
+# stored in the index, where they are already categorical (codes into a
+# level of unique names).
+COLUMNS = [
+    ("avl_bikes", "Int16"),
+    ("free_slots", "Int16"),
+    ("total_slots", "Int16"),
+    ("operative", "boolean"),
+    ("style", "category"),
+    ("lat", "float32"),
+    ("lon", "float32"),
+    ("T", "float32"),
+    ("WS_10MIN", "float32"),
+    ("P_SEA", "float32"),
+    ("R_1H", "float32")
+]
+
+# Columns stored in the station table (modules.stations), the per-minute
+# fact table and the weather table of the data file
+STATION_COLUMNS = ["lat", "lon", "style", "total_slots"]
+FACT_COLUMNS = ["avl_bikes", "free_slots", "operative"]
+WEATHER_COLUMNS = ["T", "WS_10MIN", "P_SEA", "R_1H"]
+
+# PyTables can't store missing values of integer and boolean columns, so
+# they are stored as this value in the data file
+MISSING = -1
+
+# Bytes used by one value of each type in memory (values and mask)
+__ITEMSIZE = {"Int16": 3, "boolean": 2, "category": 1, "float32": 4}
+
+# Bytes used by the index of one row in memory (date and name codes)
+__INDEX_ITEMSIZE = 8 + 2
+
+
+def apply_schema(data):
+    """Return *data* with its columns converted to the schema.
+
+    The 'coordinates' column ('lat,lon' strings) is split into 'lat' and
+    'lon'. Columns not in the schema are dropped and missing ones added
+    with missing values. Data already in the schema is left unchanged.
+    """
+    data = data.copy()
+
+    if "coordinates" in data.columns:
+        coordinates = data.pop("coordinates").astype(object).str.extract(
+            r"^\s*([-+\d.eE]+)\s*,\s*([-+\d.eE]+)\s*$")
+        data["lat"] = pd.to_numeric(coordinates[0], errors="coerce")
+        data["lon"] = pd.to_numeric(coordinates[1], errors="coerce")
+
+    columns = {}
+    for column, dtype in COLUMNS:
+        if column not in data.columns:
+            values = pd.Series(np.nan, index=data.index)
+        else:
+            values = data[column]
+
+        if dtype == "Int16":
+            values = pd.to_numeric(values, errors="coerce").astype(dtype)
+        else:
+            values = values.astype(dtype)
+
+        columns[column] = values
+
+    return pd.DataFrame(columns, index=data.index)
+
+
+def to_storage(data):
+    """Return *data* converted from the schema to types that can be
+    appended to the data file.
+
+    Integer and boolean columns are stored as int16 and int8 with
+    MISSING for missing values, categorical ones as strings. Columns
+    not in *data* are skipped.
+    """
+    data = data.copy()
+
+    for column, dtype in COLUMNS:
+        if column not in data.columns:
+            continue
+
+        if dtype == "Int16":
+            data[column] = data[column].to_numpy(dtype=np.int16,
+                                                 na_value=MISSING)
+        elif dtype == "boolean":
+            data[column] = data[column].to_numpy(dtype=np.int8,
+                                                 na_value=MISSING)
+        elif dtype == "category":
+            data[column] = data[column].astype(object)
+
+    return data
+
+
+def from_storage(data):
+    """Return *data* read from the data file converted to the schema.
+
+    The inverse of to_storage(). Columns not in *data* (when only some
+    columns were read) are skipped.
+    """
+    data = data.copy()
+
+    for column, dtype in COLUMNS:
+        if column not in data.columns:
+            continue
+
+        values = data[column].to_numpy()
+
+        if dtype == "Int16":
+            data[column] = pd.arrays.IntegerArray(values.astype(np.int16),
+                                                  values == MISSING)
+        elif dtype == "boolean":
+            data[column] = pd.arrays.BooleanArray(values == 1,
+                                                  values == MISSING)
+        else:
+            data[column] = data[column].astype(dtype)
+
+    return data
+
+
+def memory_per_row():
+    """Return estimated bytes of memory used by one loaded row."""
+    return __INDEX_ITEMSIZE + sum(__ITEMSIZE[dtype] for _, dtype in COLUMNS)
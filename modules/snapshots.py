@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""Parsing of HSL's city bike station snapshots for Fillariennustin.
+
+Snapshots are decoded straight into columnar *chunks*: dicts of typed
+NumPy arrays with one element per station row. Chunks are cheap to
+build, to pass between processes and to merge, and a DataFrame is only
+built once per batch by chunks_to_frame(). """
+
+__author__ = "Joonas Häkkinen"
+
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Fields of a station record in a snapshot's 'result' list
+STRING_FIELDS = ("coordinates", "style")
+NUMERIC_FIELDS = ("avl_bikes", "free_slots", "total_slots")
+BOOL_FIELDS = ("operative",)
+
+FILENAME_FORMAT = "stations_%Y%m%dT%H%M%SZ"
+
+
+def parse_snapshots(snapshots):
+    """Parse raw snapshots into a columnar chunk.
+
+    Returns a tuple (chunk, failures). The chunk is a dict with keys
+    'date_utc' (datetime64, UTC, rounded down to the minute), 'name'
+    and the station fields, each holding an array with one element per
+    station row. Failures is a list of (filename, reason) tuples for
+    snapshots that could not be parsed.
+
+    Arguments:
+    snapshots -- List of (filename, raw JSON bytes) tuples. Filenames
+    are of the form 'stations_yyyymmddThhmmssZ'.
+    """
+    names = []
+    results = []
+    failures = []
+
+    for filename, raw in snapshots:
+        try:
+            result = json.loads(raw)["result"]
+            if not isinstance(result, list):
+                raise TypeError("'result' is not a list")
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            failures.append((filename, str(e)))
+            continue
+
+        names.append(filename)
+        results.append(result)
+
+    counts = np.array([len(result) for result in results], dtype=np.int64)
+    total = int(counts.sum())
+
+    # Preallocate all columns for the whole set of snapshots
+    chunk = {"date_utc": __parse_dates(names).repeat(counts),
+             "name": np.empty(total, dtype=object)}
+    for field in STRING_FIELDS:
+        chunk[field] = np.empty(total, dtype=object)
+    for field in NUMERIC_FIELDS:
+        chunk[field] = np.empty(total, dtype=np.float64)
+    for field in BOOL_FIELDS:
+        chunk[field] = np.empty(total, dtype=np.bool_)
+
+    pos = 0
+    for result in results:
+        stop = pos + len(result)
+
+        chunk["name"][pos:stop] = [s.get("name") for s in result]
+        for field in STRING_FIELDS:
+            chunk[field][pos:stop] = [s.get(field) for s in result]
+        for field in NUMERIC_FIELDS:
+            chunk[field][pos:stop] = [np.nan if s.get(field) is None
+                                      else s[field] for s in result]
+        for field in BOOL_FIELDS:
+            chunk[field][pos:stop] = [bool(s.get(field)) for s in result]
+
+        pos = stop
+
+    return chunk, failures
+
+
+def parse_snapshots_parallel(snapshots, pool, workers):
+    """Parse raw snapshots in a process pool.
+
+    Works like parse_snapshots(), but *snapshots* are split into slices
+    that are parsed by *pool* (a ProcessPoolExecutor with *workers*
+    processes). Workers return compact chunks and the result is a list
+    of chunks in the order of *snapshots*, to be merged with
+    chunks_to_frame().
+    """
+    size = max(1, -(-len(snapshots) // (workers * 4)))
+    slices = [snapshots[x:x + size] for x in range(0, len(snapshots), size)]
+
+    chunks = []
+    failures = []
+    for chunk, failed in pool.map(_parse_compact, slices):
+        chunks.append(chunk)
+        failures.extend(failed)
+
+    return chunks, failures
+
+
+def new_pool(workers):
+    """Return a process pool for parse_snapshots_parallel(), or None if
+    *workers* is less than two.
+    """
+    return ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+
+def _parse_compact(snapshots):
+    """Parse *snapshots* into a chunk with factorized string columns.
+
+    Station names, styles and coordinates repeat in every snapshot, so
+    they are sent back from worker processes as (codes, uniques) tuples
+    instead of arrays of Python strings.
+    """
+    chunk, failures = parse_snapshots(snapshots)
+
+    for key in ("name",) + STRING_FIELDS:
+        codes, uniques = pd.factorize(chunk[key])
+        chunk[key] = (codes.astype(np.int32), np.asarray(uniques, object))
+
+    return chunk, failures
+
+
+def chunks_to_frame(chunks):
+    """Merge columnar *chunks* in order and return them as a DataFrame.
+
+    The DataFrame has a MultiIndex with levels 'date_utc' (UTC) and
+    'name', and one column per station field.
+    """
+    chunks = [__expand(chunk) for chunk in chunks
+              if len(chunk["date_utc"]) > 0]
+
+    if not chunks:
+        return pd.DataFrame()
+
+    columns = {key: np.concatenate([chunk[key] for chunk in chunks])
+               for key in chunks[0]}
+
+    dates = pd.DatetimeIndex(columns.pop("date_utc")).tz_localize("UTC")
+    index = pd.MultiIndex.from_arrays([dates, columns.pop("name")],
+                                      names=["date_utc", "name"])
+
+    return pd.DataFrame(columns, index=index)
+
+
+def __expand(chunk):
+    """Return *chunk* with factorized columns turned back into arrays."""
+    chunk = dict(chunk)
+
+    for key, value in chunk.items():
+        if isinstance(value, tuple):
+            codes, uniques = value
+            values = np.empty(len(codes), dtype=object)
+            values[codes >= 0] = uniques.take(codes[codes >= 0])
+            chunk[key] = values
+
+    return chunk
+
+
+def __parse_dates(filenames):
+    """Return snapshot dates from *filenames* in one vectorized pass."""
+    dates = pd.to_datetime(pd.Index(filenames, dtype=object),
+                           format=FILENAME_FORMAT)
+
+    return dates.floor("min").values.astype("datetime64[ns]")
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Station dimension table of the Fillariennustin dataset.
+
+Station attributes (coordinates, style and number of slots) rarely
+change, so they are stored once per station in a small table instead of
+on every row. Each row of the table is a version of a station's
+attributes, valid from 'valid_from' until 'valid_to' (NaT for the
+current version). Stations are identified by an integer 'station_id'
+that stays the same across versions. """
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from modules.schema import COLUMNS, STATION_COLUMNS, apply_schema
+
+TABLE_COLUMNS = ["station_id", "name"] + STATION_COLUMNS + ["valid_from",
+                                                            "valid_to"]
+
+# The first version of a station is valid from this date on, so rows
+# before the station's first appearance get its first attributes
+FIRST_VALID = pd.Timestamp("1970-01-01")
+
+
+def empty_stations():
+    """Return an empty station table."""
+    return __typed(pd.DataFrame(columns=TABLE_COLUMNS))
+
+
+def update_stations(stations, data):
+    """Return *stations* updated with the attributes found in *data*.
+
+    A new version is added whenever a station's attributes differ from
+    its previous ones, and new stations are given the next free ids.
+    Rows where all attributes are missing (minutes missing from the
+    source) are ignored.
+
+    Arguments:
+    stations -- Station table.
+    data -- DataFrame in the schema with a MultiIndex (date_utc, name),
+    in time order.
+    """
+    attrs = data[STATION_COLUMNS].reset_index()
+    attrs = attrs[attrs[STATION_COLUMNS].notna().any(axis=1)]
+    attrs = attrs.sort_values(["name", "date_utc"], kind="mergesort")
+
+    # Find rows where attributes differ from the station's previous row
+    key = __key(attrs).values
+    names = attrs.name.values
+    first = np.ones(len(attrs), dtype=bool)
+    first[1:] = names[1:] != names[:-1]
+    changed = first.copy()
+    changed[1:] |= key[1:] != key[:-1]
+
+    # A station's first row is compared to its current stored version
+    current = __key(stations[stations.valid_to.isna()].set_index("name"))
+    changed[first] = current.reindex(names[first]).values != key[first]
+
+    rows = stations.to_dict("records")
+    latest = {row["name"]: i for i, row in enumerate(rows)
+              if pd.isna(row["valid_to"])}
+    next_id = int(stations.station_id.max()) + 1 if len(stations) else 0
+
+    for change in attrs[changed].itertuples(index=False):
+        change = change._asdict()
+
+        if change["name"] in latest:
+            previous = rows[latest[change["name"]]]
+            previous["valid_to"] = change["date_utc"]
+            station_id = previous["station_id"]
+            valid_from = change["date_utc"]
+        else:
+            station_id = next_id
+            next_id += 1
+            valid_from = FIRST_VALID
+
+        latest[change["name"]] = len(rows)
+        rows.append(dict(change, station_id=station_id,
+                         valid_from=valid_from, valid_to=pd.NaT))
+
+    # Stations seen only without attributes still need an id
+    for name in data.index.unique(level="name"):
+        if name not in latest:
+            latest[name] = len(rows)
+            rows.append({"station_id": next_id, "name": name,
+                         "valid_from": FIRST_VALID, "valid_to": pd.NaT})
+            next_id += 1
+
+    return __typed(pd.DataFrame(rows, columns=TABLE_COLUMNS))
+
+
+def station_ids(stations):
+    """Return a Series mapping station names to ids."""
+    return stations.drop_duplicates("name").set_index("name").station_id
+
+
+def join_stations(facts, stations):
+    """Join station attributes to *facts*.
+
+    Returns a DataFrame with a MultiIndex (date_utc, name) and the
+    columns of *facts* together with the attributes of each station's
+    version valid at each row's date.
+
+    Arguments:
+    facts -- DataFrame with a MultiIndex (date_utc, station_id), in time
+    order.
+    stations -- Station table.
+    """
+    left = facts.reset_index()
+    left["station_id"] = left.station_id.astype(np.int64)
+    right = stations.drop(columns="valid_to").sort_values("valid_from")
+    right["station_id"] = right.station_id.astype(np.int64)
+
+    # The keys' resolutions must match (pandas 3 infers e.g. [us])
+    left["date_utc"] = left.date_utc.dt.as_unit("ns")
+    right["valid_from"] = right.valid_from.dt.as_unit("ns")
+
+    joined = pd.merge_asof(left, right, left_on="date_utc",
+                           right_on="valid_from", by="station_id")
+    joined = joined.set_index(["date_utc", "name"])
+
+    columns = [column for column, _ in COLUMNS if column in joined.columns]
+    return joined[columns]
+
+
+def __key(frame):
+    """Return station attributes in *frame* as comparable strings."""
+    key = frame[STATION_COLUMNS[0]].astype(str)
+
+    for column in STATION_COLUMNS[1:]:
+        key = key + "|" + frame[column].astype(str)
+
+    return key
+
+
+def __typed(stations):
+    """Return *stations* with columns in the types of the schema."""
+    typed = apply_schema(stations[STATION_COLUMNS])
+
+    for column in STATION_COLUMNS:
+        stations[column] = typed[column]
+
+    stations["station_id"] = stations.station_id.astype("int16")
+    stations["name"] = stations.name.astype(object)
+    stations["valid_from"] = pd.to_datetime(stations.valid_from)
+    stations["valid_to"] = pd.to_datetime(stations.valid_to)
+
+    return stations.reset_index(drop=True)
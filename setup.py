@@ -6,15 +6,29 @@ setup(
     py_modules=["fillaridata",
                 "classes.Config",
                 "classes.Datafile",
+                "classes.DatafileSet",
+                "classes.Journal",
+                "classes.SnapshotCache",
+                "classes.Source",
+                "classes.TensorExport",
+                "classes.WeatherStore",
                 "modules.data",
-                "modules.fmi"],
+                "modules.delta",
+                "modules.fmi",
+                "modules.metrics",
+                "modules.pipeline",
+                "modules.query",
+                "modules.rollups",
+                "modules.schema",
+                "modules.snapshots",
+                "modules.stations"],
     install_requires=[
         "Click",
         "appdirs",
         "numpy",
-        "pandas",
-        "bs4",
+        "pandas>=2",
         "requests",
+        "urllib3",
         "owslib",
         "lxml",
         "tables"
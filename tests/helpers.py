@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""Synthetic batches of station data for Fillariennustin's tests, built
+from the snapshots of benchmarks.fixtures. """
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.fixtures import snapshots
+from modules import data as data_module
+from modules.schema import FACT_COLUMNS, WEATHER_COLUMNS, apply_schema
+from modules.snapshots import chunks_to_frame, parse_snapshots
+
+# Stations in a test batch and the date of the first snapshot
+STATIONS = 10
+START = pd.Timestamp("2017-06-01", tz="UTC")
+
+
+def make_batch(first, minutes, stations=STATIONS):
+    """Return a batch of *minutes* minutes from minute *first* on
+    (counted from START) in the schema, as written by 'update'.
+
+    Weather of each minute is known and grows with time, column i being
+    i + minutes since START / 10.
+    """
+    raw = snapshots(first + minutes, stations)[first:]
+    chunk, _ = parse_snapshots(raw)
+    batch = getattr(data_module, "__generate_missing_rows")(
+        chunks_to_frame([chunk]))
+
+    offset = (batch.index.get_level_values(0) - START) / \
+        pd.Timedelta(minutes=1)
+    for i, column in enumerate(WEATHER_COLUMNS):
+        batch[column] = np.asarray(offset, dtype=np.float64) / 10 + i
+
+    return apply_schema(batch)
+
+
+def fact_values(data):
+    """Return station data of *data* as a float array (NaN if missing)
+    in time and station order.
+    """
+    return data.sort_index()[FACT_COLUMNS].to_numpy(dtype=np.float64,
+                                                    na_value=np.nan)
+
+
+def naive(date):
+    """Return *date* as a time zone naive (UTC) Timestamp."""
+    date = pd.Timestamp(date)
+    return date.tz_convert(None) if date.tz is not None else date
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import os
+import zlib
+
+from classes.SnapshotCache import SnapshotCache
+
+
+def snapshot(i):
+    """Return incompressible contents of about 1 KB for snapshot *i*."""
+    return os.urandom(1000) + bytes([i])
+
+
+def test_eviction_stops_when_cache_fits(tmp_path):
+    blob = len(zlib.compress(snapshot(0)))
+    cache = SnapshotCache(str(tmp_path), 10 * blob + blob // 2)
+    for i in range(11):
+        cache.put("snapshot{}".format(i), snapshot(i))
+
+    # Only the oldest snapshot goes, the one just put stays
+    assert cache.size() <= cache.max_size
+    assert cache.get("snapshot0") is None
+    for i in range(1, 11):
+        assert cache.get("snapshot{}".format(i)) is not None
+    cache.close()
+
+
+def test_snapshot_being_put_isnt_evicted(tmp_path):
+    cache = SnapshotCache(str(tmp_path), 500)
+    cache.put("snapshot0", snapshot(0))
+    cache.put("snapshot1", snapshot(1))
+
+    assert cache.get("snapshot0") is None
+    assert cache.get("snapshot1") is not None
+    cache.close()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from classes.Datafile import Datafile
+from modules.delta import decode, empty_state, encode
+from modules.schema import FACT_COLUMNS, to_storage
+from tests.helpers import fact_values, make_batch
+
+
+def storage_facts(data):
+    """Return station data of *data* as stored: storage types, naive
+    dates and station ids (here the codes of the station names).
+    """
+    facts = to_storage(data[FACT_COLUMNS])
+    facts.index = pd.MultiIndex.from_arrays(
+        [data.index.get_level_values(0).tz_convert(None),
+         data.index.codes[1].astype(np.int16)],
+        names=["date_utc", "station_id"])
+    return facts
+
+
+def with_gap(data, station, start, stop):
+    """Return *data* with rows of *station* (position) missing between
+    minutes *start* and *stop* (positions).
+    """
+    data = data.copy()
+    minutes = data.index.levels[0][start:stop]
+    name = data.index.levels[1][station]
+    rows = data.index.get_level_values(0).isin(minutes) & \
+        (data.index.get_level_values(1) == name)
+    data.loc[rows, FACT_COLUMNS] = pd.NA
+    return data
+
+
+def without(data, station):
+    """Return *data* without the rows of *station* (position)."""
+    name = data.index.levels[1][station]
+    data = data[data.index.get_level_values(1) != name]
+    data.index = data.index.remove_unused_levels()
+    return data
+
+
+def test_encode_decode_round_trip_across_batches_and_days():
+    # Two batches, the second one crossing midnight, with a gap
+    first = storage_facts(with_gap(make_batch(1380, 40), 3, 10, 20))
+    second = storage_facts(make_batch(1420, 40))
+
+    changes, state = encode(first, empty_state())
+    more, state = encode(second, state,
+                         first.index.get_level_values(0).max())
+    stored = pd.concat([changes, more])
+    assert len(stored) < len(first) + len(second)
+
+    dense = pd.concat([first, second])
+    minutes = dense.index.levels[0]
+    decoded = decode(stored, minutes)
+    np.testing.assert_array_equal(decoded.to_numpy(), dense.to_numpy())
+
+    # A day can be rebuilt from its own rows, starting on its keyframe
+    midnight = pd.Timestamp("2017-06-02")
+    day = stored[stored.index.get_level_values(0) >= midnight]
+    decoded = decode(day, minutes[minutes >= midnight])
+    expected = dense[dense.index.get_level_values(0) >= midnight]
+    np.testing.assert_array_equal(decoded.to_numpy(), expected.to_numpy())
+
+
+def test_delta_file_reads_like_dense_file(tmp_path):
+    dense = Datafile(str(tmp_path / "dense.h5"), "dense")
+    delta = Datafile(str(tmp_path / "delta.h5"), "delta")
+
+    # A gap, then a station not reported for a batch and then dropped
+    batches = [with_gap(make_batch(1380, 40), 2, 5, 15),
+               with_gap(make_batch(1420, 30), 4, 0, 30),
+               without(make_batch(1450, 30), 4)]
+    for batch in batches:
+        dense.update(batch)
+        delta.update(batch)
+
+    meta = Datafile(delta.path).metadata()
+    assert meta["mode"] == "delta"
+    assert meta["rows"] == Datafile(dense.path).metadata()["rows"]
+    assert meta["stored_rows"] < meta["rows"]
+
+    selected = Datafile(delta.path).select()
+    assert len(selected) == meta["rows"]
+    np.testing.assert_array_equal(fact_values(selected),
+                                  fact_values(Datafile(dense.path).select()))
+
+    # Ranges starting mid-day are rebuilt from the day's keyframe
+    start = pd.Timestamp("2017-06-02 00:10", tz="UTC")
+    np.testing.assert_array_equal(
+        fact_values(Datafile(delta.path).select(start=start)),
+        fact_values(Datafile(dense.path).select(start=start)))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from classes.Datafile import Datafile
+from classes.TensorExport import FEATURES, TensorExport, load_tensor
+from modules import data as data_module
+from modules.schema import WEATHER_COLUMNS
+from tests.helpers import START, make_batch
+
+
+def recent_batch(minutes):
+    """Return a batch of the last *minutes* minutes, see make_batch()."""
+    batch = make_batch(0, minutes)
+    shift = pd.Timestamp.now(tz="UTC").floor("min") - \
+        pd.Timedelta(minutes=minutes) - START
+    batch.index = batch.index.set_levels(batch.index.levels[0] + shift,
+                                         level=0)
+    return batch
+
+
+def test_follow_fills_in_late_weather(tmp_path, monkeypatch):
+    batch = recent_batch(90)
+    weather = batch[WEATHER_COLUMNS].groupby(level=0).first()
+
+    # Weather of the last 30 minutes wasn't published when written
+    late = batch.index.get_level_values(0) >= weather.index[60]
+    batch.loc[late, WEATHER_COLUMNS] = np.nan
+    datafile = Datafile(str(tmp_path / "data.h5"))
+    datafile.update(batch)
+    export = TensorExport(str(tmp_path / "export"))
+    export.append(batch)
+
+    def published(dates, api_key, store=None, tolerance=None,
+                  policy="nearest"):
+        return weather.reindex(dates)
+
+    monkeypatch.setattr(data_module, "weather_for", published)
+
+    first = getattr(data_module, "__first_missing_weather")(datafile)
+    assert first == weather.index[60]
+    assert getattr(data_module, "__fill_weather")(
+        datafile, first, "key", None, "nearest", export) is None
+
+    datafile = Datafile(datafile.path)
+    assert not datafile.select(columns=WEATHER_COLUMNS).isna().any().any()
+    rollup = datafile.rollup("hourly")
+    assert not rollup[WEATHER_COLUMNS].isna().any().any()
+
+    cube, _, stations, features = load_tensor(export.directory)
+    present = ~np.isnan(cube[:, :, features.index("lat")])
+    for column in WEATHER_COLUMNS:
+        assert not np.isnan(cube[:, :, FEATURES.index(column)][present]).any()
+
+
+def test_follow_parses_only_new_listing_names(monkeypatch):
+    update_listing = getattr(data_module, "__update_listing")
+    parse_listing = getattr(data_module, "__parse_listing")
+    names = ["stations_20170601T{:02d}0000Z".format(hour)
+             for hour in (2, 0, 1)] + ["index.html"]
+    listing = update_listing(names)
+
+    parsed = []
+
+    def counting(names):
+        parsed.extend(names)
+        return parse_listing(names)
+
+    monkeypatch.setattr(data_module, "__parse_listing", counting)
+    names += ["stations_20170601T040000Z", "stations_20170601T030000Z"]
+    listing = update_listing(names, listing)
+
+    assert sorted(parsed) == sorted(names[-2:])
+    expected = parse_listing(names)
+    np.testing.assert_array_equal(listing[0], expected[0])
+    np.testing.assert_array_equal(listing[1], expected[1])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes.Datafile import Datafile
+from classes.Journal import Journal
+from tests.helpers import fact_values, make_batch
+
+
+def fail_on_weather(monkeypatch, error):
+    """Make appends to the weather table raise *error*, after station
+    data and rollups of the batch have been written.
+    """
+    append = pd.HDFStore.append
+
+    def failing(self, key, value, *args, **kwargs):
+        if key == "weather":
+            raise error
+        return append(self, key, value, *args, **kwargs)
+
+    monkeypatch.setattr(pd.HDFStore, "append", failing)
+
+
+def written(path):
+    """Return what's read back from the data file in *path*."""
+    datafile = Datafile(path)
+    return (datafile.metadata(), datafile.select(),
+            datafile.rollup("hourly"))
+
+
+@pytest.mark.parametrize("mode", ["dense", "delta"])
+def test_failed_append_is_rolled_back(tmp_path, monkeypatch, mode):
+    path = str(tmp_path / "data.h5")
+    Datafile(path, mode).update(make_batch(0, 40))
+    meta, data, rollup = written(path)
+
+    fail_on_weather(monkeypatch, RuntimeError("disk full"))
+    datafile = Datafile(path, mode)
+    with pytest.raises(RuntimeError):
+        datafile.update(make_batch(40, 40))
+    monkeypatch.undo()
+
+    assert datafile.journal.pending() is None
+    after, data_after, rollup_after = written(path)
+    assert after["rows"] == meta["rows"]
+    assert after["last"] == meta["last"]
+    np.testing.assert_array_equal(fact_values(data_after), fact_values(data))
+    pd.testing.assert_frame_equal(rollup_after, rollup)
+
+    # The file can be appended to again
+    datafile.update(make_batch(40, 40))
+    assert Datafile(path).metadata()["rows"] == 2 * meta["rows"]
+
+
+@pytest.mark.parametrize("mode", ["dense", "delta"])
+def test_interrupted_update_is_rolled_back_on_open(tmp_path, monkeypatch,
+                                                   mode):
+    path = str(tmp_path / "data.h5")
+    Datafile(path, mode).update(make_batch(0, 40))
+    meta, data, rollup = written(path)
+
+    fail_on_weather(monkeypatch, KeyboardInterrupt())
+    with pytest.raises(KeyboardInterrupt):
+        Datafile(path, mode).update(make_batch(40, 40))
+    monkeypatch.undo()
+
+    assert Journal(path).pending() is not None
+    datafile = Datafile(path, mode)
+    assert datafile.journal.pending() is None
+
+    after, data_after, rollup_after = written(path)
+    assert after["rows"] == meta["rows"]
+    np.testing.assert_array_equal(fact_values(data_after), fact_values(data))
+    pd.testing.assert_frame_equal(rollup_after, rollup)
+
+
+def test_update_in_progress_isnt_rolled_back(tmp_path, monkeypatch):
+    path = str(tmp_path / "data.h5")
+    Datafile(path).update(make_batch(0, 40))
+
+    fail_on_weather(monkeypatch, KeyboardInterrupt())
+    with pytest.raises(KeyboardInterrupt):
+        Datafile(path).update(make_batch(40, 40))
+    monkeypatch.undo()
+
+    # A writer holding the lock, e.g. 'follow' in another process
+    with Journal(path).lock() as locked:
+        assert locked
+        Datafile(path)
+        assert Journal(path).pending() is not None
+
+    Datafile(path)
+    assert Journal(path).pending() is None
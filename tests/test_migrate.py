@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from classes.Datafile import Datafile
+from modules.schema import COLUMNS, WEATHER_COLUMNS
+from tests.helpers import STATIONS, START, fact_values, make_batch, naive
+
+
+def write_baseline_file(path, data):
+    """Write *data* (in the schema) to *path* the way the first versions
+    did: one fixed-format frame with naive dates, float and object
+    columns and coordinates as 'lat,lon' strings.
+    """
+    columns = {}
+    for column, dtype in COLUMNS:
+        if column in ("lat", "lon"):
+            continue
+        if dtype == "category":
+            columns[column] = data[column].astype(object).to_numpy()
+        else:
+            columns[column] = data[column].to_numpy(dtype=np.float64,
+                                                    na_value=np.nan)
+
+    coordinates = np.array(
+        ["{:.6f},{:.6f}".format(lat, lon)
+         for lat, lon in zip(data["lat"], data["lon"])], dtype=object)
+    coordinates[data["lat"].isna().to_numpy()] = np.nan
+    columns["coordinates"] = coordinates
+
+    index = pd.MultiIndex.from_arrays(
+        [data.index.get_level_values(0).tz_convert(None).to_numpy(),
+         data.index.get_level_values(1).to_numpy(dtype=object)],
+        names=["date_utc", "name"])
+    pd.DataFrame(columns, index=index).to_hdf(path, key="data",
+                                              format="fixed")
+
+
+def test_migrate_chunks_end_on_whole_minutes(tmp_path, monkeypatch):
+    # Chunks of 20 rows split minutes of 3 stations
+    data = make_batch(0, 11, stations=3)
+    path = str(tmp_path / "data.h5")
+    write_baseline_file(path, data)
+
+    monkeypatch.setattr("classes.Datafile.MIGRATE_CHUNKSIZE", 20)
+    Datafile(path).migrate()
+
+    with pd.HDFStore(path, mode="r") as store:
+        assert store.get_storer("weather").nrows == 11
+
+    migrated = Datafile(path).select()
+    np.testing.assert_array_equal(fact_values(migrated), fact_values(data))
+    np.testing.assert_allclose(
+        migrated.sort_index()[WEATHER_COLUMNS].to_numpy(np.float64),
+        data.sort_index()[WEATHER_COLUMNS].to_numpy(np.float64), rtol=1e-6)
+
+
+def test_migrate_fixed_format_larger_than_chunk(tmp_path, monkeypatch):
+    data = make_batch(0, 30)
+    path = str(tmp_path / "data.h5")
+    write_baseline_file(path, data)
+
+    # Not a multiple of the stations, so chunks would split minutes
+    monkeypatch.setattr("classes.Datafile.MIGRATE_CHUNKSIZE",
+                        7 * STATIONS + 3)
+    Datafile(path).migrate()
+
+    datafile = Datafile(path)
+    meta = datafile.metadata()
+    assert meta["rows"] == len(data)
+    assert naive(meta["first"]) == naive(START)
+    assert naive(meta["last"]) == naive(data.index.get_level_values(0).max())
+
+    migrated = datafile.select()
+    np.testing.assert_array_equal(fact_values(migrated), fact_values(data))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+
+from classes.DatafileSet import DatafileSet
+from tests.helpers import STATIONS, fact_values, make_batch, naive
+
+
+def test_batch_across_midnight_splits_into_partitions(tmp_path):
+    path = str(tmp_path / "data")
+    data = make_batch(1420, 40)
+    DatafileSet(path, "day").update(data)
+
+    dataset = DatafileSet(path)
+    partitions = dataset.partitions()
+    assert [p["file"] for p in partitions] == ["2017-06-01.h5",
+                                               "2017-06-02.h5"]
+
+    # Each partition records its own range
+    assert [(naive(p["first"]), naive(p["last"])) for p in partitions] == [
+        (pd.Timestamp("2017-06-01 23:40"), pd.Timestamp("2017-06-01 23:59")),
+        (pd.Timestamp("2017-06-02 00:00"), pd.Timestamp("2017-06-02 00:19"))]
+    assert len(dataset.partitions(start="2017-06-02 00:00")) == 1
+    assert len(dataset.partitions(stop="2017-06-01 23:59")) == 1
+
+    np.testing.assert_array_equal(fact_values(dataset.select()),
+                                  fact_values(data))
+
+
+def test_later_batches_roll_over_to_new_partitions(tmp_path):
+    path = str(tmp_path / "data")
+    batches = [make_batch(1400, 30), make_batch(1430, 30),
+               make_batch(1460, 30)]
+    for batch in batches:
+        DatafileSet(path, "day").update(batch)
+
+    dataset = DatafileSet(path)
+    assert [p["rows"] for p in dataset.partitions()] == \
+        [40 * STATIONS, 50 * STATIONS]
+    assert naive(dataset.last_date()) == pd.Timestamp("2017-06-02 00:49")
+
+    np.testing.assert_array_equal(fact_values(dataset.select()),
+                                  fact_values(pd.concat(batches)))
+    start = pd.Timestamp("2017-06-01 23:50", tz="UTC")
+    stop = pd.Timestamp("2017-06-02 00:10", tz="UTC")
+    selected = dataset.select(start, stop)
+    assert selected.index.get_level_values(0).nunique() == 21
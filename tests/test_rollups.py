@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes.Datafile import Datafile
+from modules.schema import WEATHER_COLUMNS
+from tests.helpers import make_batch
+
+
+@pytest.mark.parametrize("name", ["hourly", "daily"])
+def test_rollups_merge_across_batches(tmp_path, name):
+    # Batches split hours (and the day) in the middle
+    batches = Datafile(str(tmp_path / "batches.h5"))
+    for first, minutes in ((1380, 25), (1405, 50), (1455, 45)):
+        batches.update(make_batch(first, minutes))
+
+    whole = Datafile(str(tmp_path / "whole.h5"))
+    whole.update(make_batch(1380, 120))
+
+    pd.testing.assert_frame_equal(Datafile(batches.path).rollup(name),
+                                  Datafile(whole.path).rollup(name))
+
+
+def test_rollups_follow_filled_weather(tmp_path):
+    batch = make_batch(0, 90)
+    weather = batch[WEATHER_COLUMNS].groupby(level=0).first()
+
+    # Weather of the last 30 minutes wasn't published when written
+    late = batch.index.get_level_values(0) >= weather.index[60]
+    batch.loc[late, WEATHER_COLUMNS] = np.nan
+    datafile = Datafile(str(tmp_path / "data.h5"))
+    datafile.update(batch)
+
+    assert datafile.fill_weather(weather, weather.index[60]) is None
+
+    datafile = Datafile(datafile.path)
+    stored = datafile.select(columns=["T"])["T"]
+    expected = stored.groupby(
+        stored.index.get_level_values(0).floor("h")).mean()
+    rollup = datafile.rollup("hourly")["T"].groupby(level=0).first()
+
+    np.testing.assert_allclose(rollup.to_numpy(), expected.to_numpy(),
+                               rtol=1e-5)
+    np.testing.assert_allclose(
+        rollup.to_numpy(),
+        weather["T"].groupby(weather.index.floor("h")).mean().to_numpy(),
+        rtol=1e-5)
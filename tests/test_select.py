@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+__author__ = "Joonas Häkkinen"
+
+import pytest
+
+from classes.Datafile import Datafile
+from tests.helpers import make_batch
+
+
+@pytest.mark.parametrize("mode", ["dense", "delta"])
+def test_select_unknown_station_is_empty(tmp_path, mode):
+    datafile = Datafile(str(tmp_path / "data.h5"), mode)
+    datafile.update(make_batch(0, 20))
+
+    datafile = Datafile(datafile.path)
+    assert len(datafile.select(stations=["No such station"])) == 0
+    assert list(datafile.query(stations=["No such station"])) == []
+    assert len(datafile.rollup("hourly", stations=["No such station"])) == 0
+
+    name = datafile.stations().name.iloc[0]
+    assert len(datafile.select(stations=[name, "No such station"])) == 20